@@ -1,19 +1,29 @@
 import asyncio
+import bisect
+import functools
+import hashlib
+import heapq
+import inspect
 import io
 import re
 import math
-import json
+import mmap
 import logging
 import shutil
 import os
+import queue
 import sys
-from logging.handlers import RotatingFileHandler
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from datetime import datetime, timedelta
-from typing import Callable, Dict, Any, Awaitable, List, Tuple
+from typing import Callable, Dict, Any, Awaitable, List, Set, Tuple
 
-import pandas as pd
-import plotly.graph_objects as go
-import plotly.io as pio
+import numpy as np
+import orjson
+from cachetools import TTLCache
 from aiohttp import web
 from dotenv import load_dotenv
 
@@ -49,34 +59,68 @@ if LAUNCH_MODE == "webhook" and not WEBHOOK_URL:
     sys.exit(1)
 
 ADMIN_TELEGRAM_USERNAME = "weeloser"
+ADMIN_CONTACT_URL = f"https://t.me/{ADMIN_TELEGRAM_USERNAME}"
 FOUNDER_ID = ADMIN_IDS[0]
 INITIAL_ADMIN_ID = ADMIN_IDS[1] if len(ADMIN_IDS) > 1 else None
+ADMIN_IDS_SET = frozenset(ADMIN_IDS)
 
 # --- КОНСТАНТЫ ---
 ITEMS_PER_PAGE = 5
 LOGS_PER_PAGE = 10
+SEARCH_RESULTS_LIMIT = 20
+ACTION_LOG_LIMIT = 1000
 DB_FILE = 'database.json'
 STATS_FILE = 'stats.txt'
 LOG_FILE = 'bot.log'
+CHART_CACHE_DIR = 'cache'
 SPAM_LIMIT = 40
 TIME_WINDOW = 60
 BACKUP_INTERVAL_MINUTES = 15
+DB_FLUSH_DELAY_SECONDS = 1.0
+FANOUT_CONCURRENCY = 5
+BROADCAST_BATCH_SIZE = 25
+BROADCAST_RATE_PER_SECOND = 25
+CHART_WORKERS = 2
 CUSTOM_SIM_LIMIT = 15
 CUSTOM_SIM_COOLDOWN_SECONDS = 60
 PRIVATE_AUTODELETE_SECONDS = 0
 GROUP_AUTODELETE_SECONDS = 600
+DELETE_MESSAGES_BATCH = 100
 GROUP_TYPES = ("group", "supergroup")
+MESSAGE_OWNERS_MAXSIZE = 10_000
+MESSAGE_OWNERS_TTL_SECONDS = 86400
 
 # --- ИНИЦИАЛИЗАЦИЯ ---
 bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
 dp = Dispatcher()
 scheduler = AsyncIOScheduler(timezone="Europe/Moscow")
 database = {}
-user_timestamps = {}
+user_timestamps: Dict[int, deque] = {}
 broadcast_content = {}
 STATS_CACHE = {}
-message_owners: Dict[int, int] = {}
+pending_deletes: Dict[Tuple[int, int], float] = {}
+delete_heap: List[Tuple[float, int, int]] = []
+delete_wakeup = asyncio.Event()
+user_counters = {'total': 0, 'banned': 0}
+active_24h_users: OrderedDict = OrderedDict()
+active_7d_users: OrderedDict = OrderedDict()
+recent_first_starts: List[Tuple[str, int]] = []
+username_index: Dict[str, int] = {}
+users_order: List[int] = []
+active_user_ids: Set[int] = set()
+search_corpus: List[Tuple[int, str, str]] | None = None
+display_labels: Dict[int, str] = {}
+limit_buttons: Dict[int, Tuple[int, InlineKeyboardButton]] = {}
+parsed_stats_cache: Tuple[Tuple[int, int], Tuple[Dict, List]] | None = None
+message_owners: TTLCache = TTLCache(maxsize=MESSAGE_OWNERS_MAXSIZE, ttl=MESSAGE_OWNERS_TTL_SECONDS)
 broadcast_queue = asyncio.Queue()
+action_log_queue = asyncio.Queue(maxsize=ACTION_LOG_LIMIT)
+db_dirty = asyncio.Event()
+db_save_lock = asyncio.Lock()
+db_flusher_task: asyncio.Task | None = None
+db_saved_digest: bytes | None = None
+chart_pool: ProcessPoolExecutor | None = None
+log_listener: QueueListener | None = None
 
 # --- СОСТОЯНИЯ FSM ---
 class States(StatesGroup):
@@ -107,6 +151,14 @@ class RestoreStates(StatesGroup):
 
 # --- ФУНКЦИИ ВОССТАНОВЛЕНИЯ И БЭКАПА ---
 
+async def _fanout(coros: List[Awaitable], limit: int = FANOUT_CONCURRENCY) -> List[Any]:
+    """Выполняет корутины параллельно, не больше `limit` одновременно. Ошибки возвращаются в списке результатов."""
+    sem = asyncio.Semaphore(limit)
+    async def _run(coro: Awaitable):
+        async with sem:
+            return await coro
+    return await asyncio.gather(*[_run(c) for c in coros], return_exceptions=True)
+
 async def request_files_from_admin(admin_list: List[int]):
     text = (
         "‼️ <b>ВНИМАНИЕ: Бот запущен без файлов данных!</b> ‼️\n\n"
@@ -117,30 +169,30 @@ async def request_files_from_admin(admin_list: List[int]):
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="▶️ Начать восстановление", callback_data="start_restore")]
     ])
-    for admin_id in admin_list:
-        try:
-            await bot.send_message(admin_id, text, reply_markup=keyboard)
-        except Exception as e:
-            logging.error(f"Не удалось отправить запрос на восстановление админу {admin_id}: {e}")
+    results = await _fanout([bot.send_message(admin_id, text, reply_markup=keyboard) for admin_id in admin_list])
+    for admin_id, result in zip(admin_list, results):
+        if isinstance(result, Exception):
+            logging.error(f"Не удалось отправить запрос на восстановление админу {admin_id}: {result}")
 
-@dp.callback_query(F.data == "start_restore")
 async def handle_start_restore(call: CallbackQuery, state: FSMContext):
-    if call.from_user.id not in ADMIN_IDS:
+    if call.from_user.id not in ADMIN_IDS_SET:
         return await call.answer("Эта функция только для администраторов.", show_alert=True)
+    answer_callback_in_background(call)
     
     await state.set_state(RestoreStates.awaiting_db)
     await call.message.edit_text(
         "✅ <b>Процесс восстановления начат.</b>\n\n"
         "<b>Шаг 1/2:</b> Пожалуйста, отправьте файл `database.json`."
     )
-    await call.answer()
 
 @dp.message(StateFilter(RestoreStates.awaiting_db), F.document)
 async def handle_db_restore(message: Message, state: FSMContext):
     if message.document.file_name != DB_FILE:
         return await message.reply(f"❌ Ошибка. Ожидается файл с именем `{DB_FILE}`. Вы прислали `{message.document.file_name}`.")
     
-    await bot.download(message.document, destination=DB_FILE)
+    buf = io.BytesIO()
+    await bot.download(message.document, destination=buf)
+    await asyncio.to_thread(_write_bytes_sync, DB_FILE, buf.getvalue())
     await message.reply(
         f"✅ Файл `{DB_FILE}` успешно получен.\n\n"
         f"<b>Шаг 2/2:</b> Теперь, пожалуйста, отправьте файл `stats.txt`."
@@ -152,7 +204,9 @@ async def handle_stats_restore(message: Message, state: FSMContext):
     if message.document.file_name != STATS_FILE:
         return await message.reply(f"❌ Ошибка. Ожидается файл с именем `{STATS_FILE}`. Вы прислали `{message.document.file_name}`.")
 
-    await bot.download(message.document, destination=STATS_FILE)
+    buf = io.BytesIO()
+    await bot.download(message.document, destination=buf)
+    await asyncio.to_thread(_write_bytes_sync, STATS_FILE, buf.getvalue())
     await message.reply(f"✅ Файл `{STATS_FILE}` получен. Начинаю инициализацию...")
     
     await state.clear()
@@ -165,6 +219,27 @@ async def handle_stats_restore(message: Message, state: FSMContext):
         logging.critical(f"Критическая ошибка во время инициализации после восстановления: {e}")
         await message.answer(f"❌ <b>Произошла критическая ошибка при инициализации:</b>\n\n<pre>{html.quote(str(e))}</pre>")
 
+def _read_bytes_sync(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+def _write_bytes_sync(path: str, data: bytes):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def _tail_lines_sync(path: str, count: int, chunk_size: int = 8192) -> List[str]:
+    # Читает файл с конца блоками, пока не наберётся нужное число строк
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        data = b''
+        while position > 0 and data.count(b'\n') <= count:
+            step = min(chunk_size, position)
+            position -= step
+            f.seek(position)
+            data = f.read(step) + data
+    return data.decode('utf-8', errors='replace').splitlines(keepends=True)[-count:]
+
 async def scheduled_files_backup():
     if not os.path.exists(DB_FILE) or not os.path.exists(STATS_FILE):
         logging.warning("Пропуск планового бэкапа: файлы данных отсутствуют.")
@@ -174,23 +249,28 @@ async def scheduled_files_backup():
     timestamp = datetime.now().strftime('%Y-%m-%d %H:%M')
     
     try:
-        db_file = BufferedInputFile.from_file(DB_FILE, filename=f"backup_{DB_FILE}")
-        stats_file = BufferedInputFile.from_file(STATS_FILE, filename=f"backup_{STATS_FILE}")
+        db_bytes, stats_bytes = await asyncio.gather(
+            asyncio.to_thread(_read_bytes_sync, DB_FILE),
+            asyncio.to_thread(_read_bytes_sync, STATS_FILE),
+        )
+        db_file = BufferedInputFile(db_bytes, filename=f"backup_{DB_FILE}")
+        stats_file = BufferedInputFile(stats_bytes, filename=f"backup_{STATS_FILE}")
         
-        for admin_id in ADMIN_IDS:
-            try:
-                await bot.send_document(admin_id, db_file, caption=f"Автоматический бэкап БД\n{timestamp}", disable_notification=True)
-                await bot.send_document(admin_id, stats_file, caption=f"Автоматический бэкап статистики\n{timestamp}", disable_notification=True)
-            except Exception as e:
-                logging.error(f"Не удалось отправить бэкап админу {admin_id}: {e}")
-            await asyncio.sleep(0.5)
+        async def _send_backup(admin_id: int):
+            await bot.send_document(admin_id, db_file, caption=f"Автоматический бэкап БД\n{timestamp}", disable_notification=True)
+            await bot.send_document(admin_id, stats_file, caption=f"Автоматический бэкап статистики\n{timestamp}", disable_notification=True)
+
+        results = await _fanout([_send_backup(admin_id) for admin_id in ADMIN_IDS])
+        for admin_id, result in zip(ADMIN_IDS, results):
+            if isinstance(result, Exception):
+                logging.error(f"Не удалось отправить бэкап админу {admin_id}: {result}")
         logging.info("Резервное копирование файлов успешно завершено.")
     except Exception as e:
         logging.error(f"Критическая ошибка в задаче резервного копирования файлов: {e}")
 
 # --- ОСНОВНАЯ ЛОГИКА БОТА ---
 
-async def initialize_stats_file():
+def _initialize_stats_file_sync():
     try:
         with open(STATS_FILE, 'r', encoding='utf-8') as f:
             if not f.read().strip():
@@ -225,79 +305,197 @@ ENTRY: 100
         with open(STATS_FILE, 'w', encoding='utf-8') as f:
             f.write(template)
 
+async def initialize_stats_file():
+    await asyncio.to_thread(_initialize_stats_file_sync)
+
 async def create_stats_backup():
     backup_filename = f"stats_backup_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.txt"
     try:
-        shutil.copy(STATS_FILE, backup_filename)
+        await asyncio.to_thread(shutil.copyfile, STATS_FILE, backup_filename)
         logging.info(f"Создана резервная копия статистики: {backup_filename}")
         return True
     except Exception as e:
         logging.error(f"Не удалось создать резервную копию stats.txt: {e}")
         return False
 
+def _load_database_sync() -> Dict:
+    try:
+        return orjson.loads(_read_bytes_sync(DB_FILE))
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return {}
+
 async def load_database():
     global database
-    try:
-        with open(DB_FILE, 'r', encoding='utf-8') as f:
-            database = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        database = {}
-    if 'users' not in database: database['users'] = {}
-    if 'admins' not in database: database['admins'] = ADMIN_IDS
-    if 'action_log' not in database: database['action_log'] = []
-    if 'group_chats' not in database: database['group_chats'] = []
-    await save_database()
-
-async def save_database():
-    try:
-        if 'group_chats' in database and isinstance(database['group_chats'], set):
-            database['group_chats'] = list(database['group_chats'])
-        with open(DB_FILE, 'w', encoding='utf-8') as f:
-            json.dump(database, f, indent=4, ensure_ascii=False)
-    except Exception as e:
-        logging.error(f"Ошибка сохранения БД: {e}")
+    database = await asyncio.to_thread(_load_database_sync)
+    # В JSON ключи всегда строки, в памяти храним пользователей по int id
+    database['users'] = {int(uid): data for uid, data in database.get('users', {}).items()}
+    # Множества сериализуются обратно в списки через default=list при сохранении
+    database['admins'] = frozenset(database.get('admins', ADMIN_IDS))
+    database['action_log'] = deque(database.get('action_log', []), maxlen=ACTION_LOG_LIMIT)
+    database['group_chats'] = set(database.get('group_chats', []))
+    rebuild_user_indexes()
+    mark_db_dirty()
+
+def _save_database_sync(db: Dict):
+    global db_saved_digest
+    data = orjson.dumps(db, default=list, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    digest = hashlib.blake2b(data, digest_size=16).digest()
+    if digest == db_saved_digest and os.path.exists(DB_FILE):
+        return
+    # Пишем во временный файл и атомарно подменяем, чтобы сбой посреди записи не испортил БД
+    tmp_path = f"{DB_FILE}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, DB_FILE)
+    db_saved_digest = digest
+
+async def _save_database_now():
+    async with db_save_lock:
+        try:
+            snapshot = dict(database)
+            await asyncio.to_thread(_save_database_sync, snapshot)
+        except Exception as e:
+            logging.error(f"Ошибка сохранения БД: {e}")
+
+def mark_db_dirty():
+    # Запись на диск откладывается: несколько изменений подряд сливаются в одну перезапись файла
+    db_dirty.set()
+
+async def db_flusher():
+    while True:
+        await db_dirty.wait()
+        await asyncio.sleep(DB_FLUSH_DELAY_SECONDS)
+        db_dirty.clear()
+        await _save_database_now()
 
 async def save_context_message(user_id: int, message_id: int):
-    user_id_str = str(user_id)
-    if user_id_str in database['users']:
-        database['users'][user_id_str]['context_message_id'] = message_id
-        await save_database()
+    if user_id in database['users']:
+        database['users'][user_id]['context_message_id'] = message_id
+        mark_db_dirty()
 
-async def delete_context_message(user_id: int, chat_id: int):
-    user_id_str = str(user_id)
-    user_data = database['users'].get(user_id_str, {})
-    msg_id = user_data.get('context_message_id')
+def pop_context_message_id(user_id: int) -> int | None:
+    user_data = database['users'].get(user_id)
+    msg_id = user_data.get('context_message_id') if user_data else None
     if msg_id:
-        try:
-            await bot.delete_message(chat_id, msg_id)
-        except TelegramBadRequest:
-            pass
-        if user_id_str in database['users']:
-            database['users'][user_id_str]['context_message_id'] = None
-            await save_database()
-
-def get_user_sim_limit(user_id: int) -> int:
-    user_id_str = str(user_id)
-    user_data = database['users'].get(user_id_str, {})
-    today = datetime.now().strftime("%Y-%m-%d")
-    if 'limits' not in user_data or user_data.get('limits', {}).get('date') != today:
-        user_data['limits'] = {'date': today, 'used_count': 0}
-        database['users'][user_id_str] = user_data
-    return user_data['limits']['used_count']
+        user_data['context_message_id'] = None
+        mark_db_dirty()
+    return msg_id
+
+async def delete_messages_quietly(chat_id: int, *message_ids: int | None):
+    # Несколько сообщений удаляются одним запросом deleteMessages вместо отдельных вызовов
+    ids = [mid for mid in message_ids if mid]
+    if not ids: return
+    for mid in ids:
+        cancel_scheduled_delete(chat_id, mid)
+    try:
+        await bot.delete_messages(chat_id, ids)
+    except TelegramBadRequest:
+        pass
+
+async def delete_context_message(user_id: int, chat_id: int):
+    await delete_messages_quietly(chat_id, pop_context_message_id(user_id))
+
+def get_user_sim_limit(user_id: int, today: str | None = None) -> int:
+    # Счётчик попыток за день хранится прямо в записи пользователя; при выводе списка дату передают один раз на страницу
+    user_data = database['users'].get(user_id)
+    if user_data is None:
+        user_data = add_user_record_counted(user_id, {})
+    today = today or datetime.now().strftime("%Y-%m-%d")
+    limits = user_data.get('limits')
+    if not limits or limits.get('date') != today:
+        limits = user_data['limits'] = {'date': today, 'used_count': 0}
+    return limits['used_count']
 
 async def increment_user_sim_limit(user_id: int):
-    user_id_str = str(user_id)
     get_user_sim_limit(user_id)
-    database['users'][user_id_str]['limits']['used_count'] += 1
-    await save_database()
+    database['users'][user_id]['limits']['used_count'] += 1
+    limit_buttons.pop(user_id, None)
+    mark_db_dirty()
 
 async def set_user_sim_attempts(user_id: int, remaining_amount: int):
-    user_id_str = str(user_id)
     get_user_sim_limit(user_id)
     new_used_count = CUSTOM_SIM_LIMIT - remaining_amount
-    database['users'][user_id_str]['limits']['used_count'] = max(0, new_used_count)
-    await save_database()
-    return CUSTOM_SIM_LIMIT - database['users'][user_id_str]['limits']['used_count']
+    database['users'][user_id]['limits']['used_count'] = max(0, new_used_count)
+    limit_buttons.pop(user_id, None)
+    mark_db_dirty()
+    return CUSTOM_SIM_LIMIT - database['users'][user_id]['limits']['used_count']
+
+_SUMMARY_RE = re.compile(
+    r"Чистое движение:\s*(.*?)\s*\n"
+    r"Винрейт:\s*(.*?)\s*\n"
+    r"Всего сделок:\s*(.*?)\s*\n"
+    r"Успешных:\s*(.*?)\s*\n"
+    r"Убыточных:\s*(.*?)\s*\n"
+    r"В безубыток:\s*(.*?)\s*\n"
+    r"В отработке:\s*(.*?)\s*\n\s*"
+    r"Начало\s*-\s*(.*?)\s*\n"
+    r"Последнее обновление\s*-\s*(.*?)\s*\n"
+)
+_TRADE_START_RE = re.compile(r'[A-Z0-9]+\s+\((?:long|short)\)')
+_TITLE_RE = re.compile(r"(.+?)\s+\((long|short)\)")
+_EXITS_RE = re.compile(r'([0-9.,]+)\s*\(([\d.]+)%\)')
+_TRADE_KEY_MAP = {'чистое движение': 'pnl', 'entry': 'entry', 'маржа': 'margin', 'фиксации': 'exits', 'дата': 'date'}
+_QUOTED_TRADE_FIELDS = (('ticker', 'N/A'), ('date', 'N/A'), ('pnl', 'N/A'), ('margin', 'N/A'), ('entry', 'N/A'), ('exits', 'б/у'))
+STATS_SEPARATOR = '--- Статистика: Илья Власов - Грабитель ММ ---'
+
+def _find_separators(lines: List[str], limit: int = 2) -> List[int]:
+    # Нужны только первые два разделителя, дальше файл не просматривается
+    found = []
+    for i, line in enumerate(lines):
+        if STATS_SEPARATOR in line:
+            found.append(i)
+            if len(found) == limit: break
+    return found
+
+def _parse_dotted_date(text: str) -> datetime:
+    """Разбирает дату вида ДД.ММ.ГГГГ или ДД.ММ.ГГ без strptime (тот же век для ГГ, что и у %y)."""
+    day, month, year = text.split('.')
+    if not (day.isdigit() and month.isdigit() and year.isdigit()) or len(day) > 2 or len(month) > 2:
+        raise ValueError(f"неверная дата: {text}")
+    if len(year) == 2:
+        full_year = int(year) + (2000 if int(year) < 69 else 1900)
+    elif len(year) == 4:
+        full_year = int(year)
+    else:
+        raise ValueError(f"неверная дата: {text}")
+    return datetime(full_year, int(month), int(day))
+
+def _build_trade(block_lines: List[str], index: int) -> Dict | None:
+    title_match = _TITLE_RE.match(block_lines[0])
+    if not title_match:
+        logging.warning(f"Пропуск блока сделки с неверным форматом заголовка: {block_lines[0]}")
+        return None
+
+    trade = {'in_progress': False, 'original_index': index}
+    trade['ticker'], trade['type'] = title_match.groups()
+    for line in block_lines[1:]:
+        idx = line.find(':')
+        if idx < 0: continue
+        key = line[:idx].strip().lower()
+        value = line[idx + 1:].strip()
+        if key == 'фиксации' and 'в отработке' in value.lower():
+            trade['in_progress'] = True
+        field = _TRADE_KEY_MAP.get(key)
+        if field: trade[field] = value
+
+    if trade['in_progress']:
+        trade['pnl_value'] = 0.0
+    elif 'pnl' in trade:
+        try:
+            trade['pnl_value'] = float(trade['pnl'].replace('%', ''))
+        except (ValueError, TypeError):
+            trade['pnl_value'] = 0.0
+
+    if 'date' in trade:
+        try:
+            trade['date_dt'] = _parse_dotted_date(trade['date'])
+        except ValueError:
+            return None
+
+    # Экранированные для HTML копии полей, чтобы не вызывать html.quote при каждом выводе
+    for field, default in _QUOTED_TRADE_FIELDS:
+        trade[f'_q_{field}'] = html.quote(trade.get(field, default))
+    return trade
 
 def _parse_stats_data_sync(content: str = None) -> Tuple[Dict, List]:
     lines = []
@@ -312,78 +510,36 @@ def _parse_stats_data_sync(content: str = None) -> Tuple[Dict, List]:
         lines = content.splitlines(keepends=True)
 
     summary, trades = {}, []
-    separator = '--- Статистика: Илья Власов - Грабитель ММ ---'
     
     try:
-        sep_indices = [i for i, line in enumerate(lines) if separator in line]
+        sep_indices = _find_separators(lines)
         if len(sep_indices) < 2:
             logging.error("Неверный формат файла stats.txt: не найдены разделители.")
             return {}, []
 
         summary_lines = lines[sep_indices[0] + 1 : sep_indices[1]]
         summary_content = "".join(summary_lines)
-        summary_regex = (
-            r"Чистое движение:\s*(.*?)\s*\n"
-            r"Винрейт:\s*(.*?)\s*\n"
-            r"Всего сделок:\s*(.*?)\s*\n"
-            r"Успешных:\s*(.*?)\s*\n"
-            r"Убыточных:\s*(.*?)\s*\n"
-            r"В безубыток:\s*(.*?)\s*\n"
-            r"В отработке:\s*(.*?)\s*\n\s*"
-            r"Начало\s*-\s*(.*?)\s*\n"
-            r"Последнее обновление\s*-\s*(.*?)\s*\n"
-        )
-        summary_match = re.search(summary_regex, summary_content)
+        summary_match = _SUMMARY_RE.search(summary_content)
         if summary_match:
             keys = ["total_pnl", "winrate", "total_deals", "successful", "losing", "breakeven", "in_progress", "start_date", "last_update"]
             summary = dict(zip(keys, [g.strip() for g in summary_match.groups()]))
 
-        trades_content = "".join(lines[sep_indices[1] + 1:])
-        trade_blocks = re.split(r'\n\s*\n+(?=[A-Z0-9]+\s+\((?:long|short)\))', trades_content.strip())
-        
-        for i, block in enumerate(trade_blocks):
-            if not block.strip(): continue
-            
-            trade = {'in_progress': False, 'original_index': i}
-            block_lines = [line.strip() for line in block.strip().split('\n') if line.strip()]
-            if not block_lines: continue
-
-            title_match = re.match(r"(.+?)\s+\((long|short)\)", block_lines[0])
-            if title_match:
-                trade['ticker'], trade['type'] = title_match.groups()
-            else:
-                logging.warning(f"Пропуск блока сделки с неверным форматом заголовка: {block_lines[0]}")
+        # Один проход по строкам: новый блок начинается с заголовка сделки после пустой строки
+        block, block_index, prev_blank = [], -1, True
+        for raw_line in lines[sep_indices[1] + 1:]:
+            line = raw_line.strip()
+            if not line:
+                prev_blank = True
                 continue
-            
-            for line in block_lines[1:]:
-                if ':' in line:
-                    key, value = [x.strip() for x in line.split(':', 1)]
-                    key_map = {'чистое движение': 'pnl', 'entry': 'entry', 'маржа': 'margin', 'фиксации': 'exits', 'дата': 'date'}
-                    
-                    if key.lower() == 'фиксации' and 'в отработке' in value.lower():
-                        trade['in_progress'] = True
-                    
-                    trade[key_map.get(key.lower())] = value
-
-            if trade['in_progress']:
-                trade['pnl_value'] = 0.0
-            elif 'pnl' in trade:
-                try:
-                    trade['pnl_value'] = float(trade['pnl'].replace('%', ''))
-                except (ValueError, TypeError):
-                    trade['pnl_value'] = 0.0
-
-            if 'date' in trade:
-                try:
-                    trade['date_dt'] = datetime.strptime(trade['date'], "%d.%m.%Y")
-                except ValueError:
-                    try:
-                        trade['date_dt'] = datetime.strptime(trade['date'], "%d.%m.%y")
-                    except ValueError:
-                        continue
-            
-            if 'ticker' in trade:
-                trades.append(trade)
+            if not block or (prev_blank and _TRADE_START_RE.match(raw_line)):
+                if block and (trade := _build_trade(block, block_index)):
+                    trades.append(trade)
+                block = []
+                block_index += 1
+            block.append(line)
+            prev_blank = False
+        if block and (trade := _build_trade(block, block_index)):
+            trades.append(trade)
     except Exception as e:
         logging.error(f"Ошибка при парсинге stats.txt: {e}")
         return {}, []
@@ -391,124 +547,188 @@ def _parse_stats_data_sync(content: str = None) -> Tuple[Dict, List]:
     return summary, trades
 
 async def parse_stats_data():
-    return await asyncio.to_thread(_parse_stats_data_sync)
+    # Проверка и последующая перезапись шапки идут подряд, поэтому результат разбора переиспользуется,
+    # пока у файла не изменились время модификации и размер
+    global parsed_stats_cache
+    try:
+        st = os.stat(STATS_FILE)
+        file_key = (st.st_mtime_ns, st.st_size)
+    except FileNotFoundError:
+        file_key = None
+    if file_key and parsed_stats_cache and parsed_stats_cache[0] == file_key:
+        return parsed_stats_cache[1]
+    result = await asyncio.to_thread(_parse_stats_data_sync)
+    parsed_stats_cache = (file_key, result) if file_key and result[1] else None
+    return result
+
+def _rewrite_stats_header_sync(header_content: str):
+    """Заменяет шапку между двумя разделителями, копируя текст сделок во временный файл без разбора."""
+    sep = STATS_SEPARATOR.encode('utf-8')
+    tmp_path = f"{STATS_FILE}.tmp"
+    with open(STATS_FILE, 'rb') as f:
+        # Разделители ищутся прямо в отображённом файле, без чтения его целиком в память
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            first = mm.find(sep)
+            second = mm.find(sep, first + len(sep)) if first != -1 else -1
+        if second == -1:
+            raise ValueError("не найдены разделители шапки")
+        start = first + len(sep)
+        new_header = f"\n{header_content}\n\n\n".encode('utf-8')
+        # Запись всегда идёт через временный файл и атомарную замену, чтобы сбой не оставил файл наполовину записанным
+        with open(tmp_path, 'wb') as out:
+            f.seek(0)
+            out.write(f.read(start))
+            out.write(new_header)
+            f.seek(second)
+            shutil.copyfileobj(f, out)
+    os.replace(tmp_path, STATS_FILE)
+
+def _compute_stats_summary(trades: List[Dict]) -> Dict[str, Any]:
+    """Итоговые показатели для шапки stats.txt по списку сделок."""
+    count = len(trades)
+    pnl = np.fromiter((t.get('pnl_value', 0) for t in trades), dtype=np.float64, count=count)
+    in_progress = np.fromiter((bool(t.get('in_progress')) for t in trades), dtype=bool, count=count)
+    completed = ~in_progress
+    successful = int(np.count_nonzero((pnl > 0) & completed))
+    losing = int(np.count_nonzero((pnl < 0) & completed))
+    return {
+        'total_deals': count,
+        'successful': successful,
+        'losing': losing,
+        'breakeven': int(np.count_nonzero(completed)) - successful - losing,
+        'in_progress': int(np.count_nonzero(in_progress)),
+        'winrate': (successful / (successful + losing) * 100) if (successful + losing) > 0 else 0,
+        'total_pnl': float(pnl[completed].sum()),
+        'last_trade_date': max((t['date_dt'] for t in trades if 'date_dt' in t), default=None),
+    }
 
 def _calculate_streaks_sync(trades: List[Dict]) -> Tuple[int, int, int]:
     if not trades: return 0, 0, 0
     
-    streaks = {'win': 0, 'loss': 0, 'be': 0}
-    max_streaks = {'win': 0, 'loss': 0, 'be': 0}
-    
     completed_trades = [t for t in trades if not t.get('in_progress') and 'date_dt' in t]
     chrono_trades = sorted(completed_trades, key=lambda x: (x['date_dt'], -x.get('original_index', 0)))
-
-    for trade in chrono_trades:
-        pnl = trade.get('pnl_value', 0)
-        if pnl > 0:
-            streaks['win'] += 1
-            streaks['loss'] = 0
-            streaks['be'] = 0
-        elif pnl < 0:
-            streaks['loss'] += 1
-            streaks['win'] = 0
-            streaks['be'] = 0
-        else:
-            streaks['be'] += 1
-            streaks['win'] = 0
-            streaks['loss'] = 0
-            
-        max_streaks['win'] = max(max_streaks['win'], streaks['win'])
-        max_streaks['loss'] = max(max_streaks['loss'], streaks['loss'])
-        max_streaks['be'] = max(max_streaks['be'], streaks['be'])
-        
-    return max_streaks['win'], max_streaks['loss'], max_streaks['be']
-
-async def _create_chart_versions(fig: go.Figure, html_title: str = "Интерактивный график") -> Tuple[io.BytesIO, io.BytesIO]:
-    def _sync_worker():
+    if not chrono_trades: return 0, 0, 0
+
+    pnl = np.fromiter((t.get('pnl_value', 0) for t in chrono_trades), dtype=np.float64, count=len(chrono_trades))
+    sign = np.sign(pnl).astype(np.int8)
+
+    # Run-length encoding: границы серий там, где меняется знак PnL
+    change = np.concatenate(([True], sign[1:] != sign[:-1], [True]))
+    idx = np.flatnonzero(change)
+    lens = np.diff(idx)
+    vals = sign[idx[:-1]]
+
+    win = int(lens[vals == 1].max(initial=0))
+    loss = int(lens[vals == -1].max(initial=0))
+    be = int(lens[vals == 0].max(initial=0))
+    return win, loss, be
+
+def _render_png_matplotlib(kind: str, data: Dict) -> bytes:
+    """Рисует PNG-версию графика через matplotlib (Agg) — без запуска Kaleido/Chromium."""
+    # Графические библиотеки импортируются лениво, чтобы не замедлять старт бота
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=(8, 4.5), dpi=200)
+    ax = fig.subplots()
+    if kind == 'pie':
+        ax.pie(data['values'], labels=data['labels'], colors=data['colors'], explode=data.get('explode'),
+               autopct='%1.1f%%', startangle=90, counterclock=False,
+               wedgeprops={'width': 0.7}, textprops={'color': 'white'})
+        ax.axis('equal')
+    else:
+        ax.plot(data['x'], data['y'], color=data.get('color', '#636EFA'), linewidth=2, marker='o', markersize=3)
+        ax.set_xlabel(data['xlabel'], color='white')
+        ax.set_ylabel(data['ylabel'], color='white')
+        ax.grid(color='#444444', linewidth=0.5)
+        ax.tick_params(colors='white')
+        for spine in ax.spines.values():
+            spine.set_color('#444444')
+    ax.set_title(data['title'], color='white')
+    fig.tight_layout()
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', transparent=True)
+    return buf.getvalue()
+
+async def render_png(kind: str, data: Dict) -> bytes:
+    # Отрисовка PNG нагружает CPU под GIL, поэтому идёт в отдельных процессах, а не в потоках
+    return await asyncio.get_running_loop().run_in_executor(chart_pool, _render_png_matplotlib, kind, data)
+
+async def _create_chart_versions(fig: Any, png_data: Dict, html_title: str = "Интерактивный график") -> Tuple[bytes, bytes]:
+    def _html_worker():
+        import plotly.io as pio
         config = {'displaylogo': False, 'modeBarButtonsToRemove': ['lasso2d', 'select2d'], 'scrollZoom': True}
         html_fig_str = pio.to_html(fig, full_html=False, include_plotlyjs='cdn', config=config)
         full_html = f"""
         <!DOCTYPE html><html><head><meta charset="UTF-8"><title>{html.quote(html_title)}</title>
         <style>body {{ margin: 0; background-color: #111; }}</style></head><body>{html_fig_str}</body></html>
         """
-        html_buf = io.BytesIO(full_html.encode('utf-8'))
-        html_buf.seek(0)
-        
-        fig.update_layout(paper_bgcolor='rgba(0,0,0,0)', plot_bgcolor='rgba(0,0,0,0)')
-        img_bytes = pio.to_image(fig, format='png', scale=2, width=800, height=450)
-        png_buf = io.BytesIO(img_bytes)
-        png_buf.seek(0)
-        return html_buf, png_buf
-    return await asyncio.to_thread(_sync_worker)
+        return full_html.encode('utf-8')
+    html_bytes, img_bytes = await asyncio.gather(asyncio.to_thread(_html_worker), render_png('line', png_data))
+    return html_bytes, img_bytes
 
-async def plot_summary_chart(summary: Dict) -> io.BytesIO | None:
-    def _sync_worker():
-        try:
-            labels = ['Успешных', 'Убыточных', 'В безубыток']
-            values = [int(summary.get('successful', 0)), int(summary.get('losing', 0)), int(summary.get('breakeven', 0))]
-            colors = ['#4CAF50', '#F44336', '#9E9E9E']
-            if sum(values) == 0: return None
-        except (ValueError, TypeError):
-            logging.error("Ошибка преобразования данных для кругового графика.")
-            return None
-            
-        fig = go.Figure(data=[go.Pie(labels=labels, values=values, hole=.3, marker_colors=colors, textinfo='percent+label', pull=[0.05, 0, 0])])
-        fig.update_layout(title_text='Соотношение сделок', template='plotly_dark', font=dict(color='white'), showlegend=False)
-        
-        fig.update_layout(paper_bgcolor='rgba(0,0,0,0)', plot_bgcolor='rgba(0,0,0,0)')
-        img_bytes = pio.to_image(fig, format='png', scale=2, width=800, height=450)
-        png_buf = io.BytesIO(img_bytes)
-        png_buf.seek(0)
-        return png_buf
-    return await asyncio.to_thread(_sync_worker)
+async def plot_summary_chart(summary: Dict) -> bytes | None:
+    try:
+        labels = ['Успешных', 'Убыточных', 'В безубыток']
+        values = [int(summary.get('successful', 0)), int(summary.get('losing', 0)), int(summary.get('breakeven', 0))]
+        colors = ['#4CAF50', '#F44336', '#9E9E9E']
+        if sum(values) == 0: return None
+    except (ValueError, TypeError):
+        logging.error("Ошибка преобразования данных для кругового графика.")
+        return None
 
-async def plot_pnl_chart(trades: List[Dict]) -> Tuple[io.BytesIO, io.BytesIO] | Tuple[None, None]:
+    return await render_png('pie', {'title': 'Соотношение сделок', 'labels': labels, 'values': values, 'colors': colors, 'explode': [0.05, 0, 0]})
+
+async def plot_pnl_chart(trades: List[Dict]) -> Tuple[bytes, bytes] | Tuple[None, None]:
     def _sync_worker():
         completed_trades = [t for t in trades if not t.get('in_progress') and 'date_dt' in t]
-        if not completed_trades: return None, None
+        if not completed_trades: return None
         
         chrono_trades = sorted(completed_trades, key=lambda x: (x['date_dt'], -x.get('original_index', 0)))
         
-        df = pd.DataFrame(chrono_trades)
-        if 'pnl_value' not in df.columns: return None, None
-        df['cumulative_pnl'] = df['pnl_value'].cumsum()
+        if not any('pnl_value' in t for t in chrono_trades): return None
+        pnl = np.fromiter((t.get('pnl_value', np.nan) for t in chrono_trades), dtype=np.float64, count=len(chrono_trades))
+        cumulative_pnl = np.nancumsum(pnl)
         
-        hover_texts = [f"<b>{row['ticker']}</b><br>PnL сделки: {row['pnl_value']:.2f}%" for index, row in df.iterrows()]
+        hover_texts = [f"<b>{t['_q_ticker']}</b><br>PnL сделки: {p:.2f}%" for t, p in zip(chrono_trades, pnl)]
 
+        import plotly.graph_objects as go
         fig = go.Figure()
         fig.add_trace(go.Scatter(
-            x=df.index, y=df['cumulative_pnl'], mode='lines+markers', name='Кумулятивный PnL',
+            x=np.arange(len(cumulative_pnl)), y=cumulative_pnl, mode='lines+markers', name='Кумулятивный PnL',
             text=hover_texts, hovertemplate="""%{text}<br><b>Итоговый PnL: %{y:.2f}%</b><br>Сделка №%{x}<extra></extra>"""
         ))
         fig.update_layout(title='Динамика общего PnL (%)', xaxis_title='Номер сделки', yaxis_title='Кумулятивный PnL (%)', template='plotly_dark', font=dict(color='white'))
-        return fig
+        png_data = {'title': 'Динамика общего PnL (%)', 'xlabel': 'Номер сделки', 'ylabel': 'Кумулятивный PnL (%)', 'x': np.arange(len(cumulative_pnl)), 'y': cumulative_pnl}
+        return fig, png_data
 
-    fig = await asyncio.to_thread(_sync_worker)
-    if fig is None: return None, None
-    return await _create_chart_versions(fig, html_title="Интерактивный график PnL")
+    result = await asyncio.to_thread(_sync_worker)
+    if result is None: return None, None
+    fig, png_data = result
+    return await _create_chart_versions(fig, png_data, html_title="Интерактивный график PnL")
 
 async def calculate_simulation(trades, sim_type, initial_balance, risk_percent, leverage) -> Dict:
     def _sync_worker():
-        current_balance = initial_balance
-        balance_history = [0.0]
         completed_trades = [t for t in trades if not t.get('in_progress') and 'date_dt' in t]
         
         chrono_trades = sorted(completed_trades, key=lambda x: (x['date_dt'], -x.get('original_index', 0)))
 
-        for trade in chrono_trades:
-            pnl_percent = trade.get('pnl_value', 0.0)
-            trade_capital = current_balance * (risk_percent / 100.0) if sim_type == 'compound' else initial_balance * (risk_percent / 100.0)
-            position_size = trade_capital * leverage
-            profit_or_loss = position_size * (pnl_percent / 100.0)
-            current_balance += profit_or_loss
-            growth_percent = (current_balance / initial_balance - 1) * 100 if initial_balance > 0 else 0
-            balance_history.append(growth_percent)
-        return {'min_percent': min(balance_history), 'max_percent': max(balance_history), 'final_percent': balance_history[-1], 'final_balance': current_balance, 'history': balance_history}
+        pnl = np.fromiter((t.get('pnl_value', 0.0) for t in chrono_trades), dtype=np.float64, count=len(chrono_trades))
+        # Доля баланса, которую приносит (или забирает) каждая сделка
+        trade_returns = (risk_percent / 100.0) * leverage * (pnl / 100.0)
+        if sim_type == 'compound':
+            balances = initial_balance * np.concatenate(([1.0], np.cumprod(1.0 + trade_returns)))
+        else:
+            balances = initial_balance + np.concatenate(([0.0], np.cumsum(initial_balance * trade_returns)))
+        if initial_balance > 0:
+            history = (balances / initial_balance - 1) * 100
+        else:
+            history = np.zeros_like(balances)
+        return {'min_percent': float(history.min()), 'max_percent': float(history.max()), 'final_percent': float(history[-1]), 'final_balance': float(balances[-1]), 'history': history.tolist()}
     return await asyncio.to_thread(_sync_worker)
 
-async def plot_simulation_chart(history: List[float]) -> Tuple[io.BytesIO, io.BytesIO] | Tuple[None, None]:
+async def plot_simulation_chart(history: List[float]) -> Tuple[bytes, bytes] | Tuple[None, None]:
     def _sync_worker():
         if not history: return None
+        import plotly.graph_objects as go
         fig = go.Figure()
         fig.add_trace(go.Scatter(
             x=list(range(len(history))), y=history, mode='lines+markers', name='Изменение депозита',
@@ -516,14 +736,94 @@ async def plot_simulation_chart(history: List[float]) -> Tuple[io.BytesIO, io.By
             hovertemplate="Сделка №%{x}<br><b>Изменение депозита: %{y:.2f}%</b><extra></extra>"
         ))
         fig.update_layout(title_text='Симуляция изменения депозита', xaxis_title='Номер сделки', yaxis_title='Изменение депозита (%)', template='plotly_dark', font=dict(color='white'))
-        return fig
-    
-    fig = await asyncio.to_thread(_sync_worker)
-    if fig is None: return None, None
-    return await _create_chart_versions(fig, html_title="Интерактивная симуляция")
+        png_data = {'title': 'Симуляция изменения депозита', 'xlabel': 'Номер сделки', 'ylabel': 'Изменение депозита (%)', 'x': list(range(len(history))), 'y': history, 'color': '#FFD700'}
+        return fig, png_data
+    
+    result = await asyncio.to_thread(_sync_worker)
+    if result is None: return None, None
+    fig, png_data = result
+    return await _create_chart_versions(fig, png_data, html_title="Интерактивная симуляция")
+
+# Версия отрисовки входит в ключ дискового кэша: при изменении оформления графиков её нужно увеличить
+CHART_RENDER_VERSION = 1
+CHART_CACHE_KEYS = ("pnl_chart_html", "pnl_chart_png", "summary_chart_png")
+# Графики симуляций отсутствуют, если истории нет, и их отсутствие в кэше не считается промахом
+CHART_CACHE_OPTIONAL_KEYS = (
+    "sim_compound_chart_html", "sim_compound_chart_png",
+    "sim_simple_chart_html", "sim_simple_chart_png",
+)
+CHART_CACHE_COMPLETE_MARK = "complete"
+
+def _chart_cache_dir(stats_hash: str) -> str:
+    return os.path.join(CHART_CACHE_DIR, f"v{CHART_RENDER_VERSION}-{stats_hash}")
+
+def _hash_stats_file_sync() -> str | None:
+    try:
+        with open(STATS_FILE, 'rb') as f:
+            return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+    except FileNotFoundError:
+        return None
+
+def _load_cached_charts_sync(stats_hash: str) -> Dict[str, bytes | None] | None:
+    cache_dir = _chart_cache_dir(stats_hash)
+    if not os.path.exists(os.path.join(cache_dir, CHART_CACHE_COMPLETE_MARK)):
+        return None
+    charts = {}
+    for key in CHART_CACHE_KEYS + CHART_CACHE_OPTIONAL_KEYS:
+        try:
+            with open(os.path.join(cache_dir, key), 'rb') as f:
+                charts[key] = f.read()
+        except FileNotFoundError:
+            if key in CHART_CACHE_KEYS: return None
+            charts[key] = None
+    return charts
 
-async def update_stats_cache():
+def _save_cached_charts_sync(stats_hash: str, charts: Dict[str, bytes]):
+    try:
+        cache_dir = _chart_cache_dir(stats_hash)
+        if os.path.isdir(CHART_CACHE_DIR):
+            for old_name in os.listdir(CHART_CACHE_DIR):
+                old_dir = os.path.join(CHART_CACHE_DIR, old_name)
+                if old_dir != cache_dir:
+                    shutil.rmtree(old_dir, ignore_errors=True)
+        # Прежняя запись под тем же ключом удаляется, чтобы в ней не остались лишние графики симуляций
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        os.makedirs(cache_dir, exist_ok=True)
+        for key, data in charts.items():
+            if data is None: continue
+            with open(os.path.join(cache_dir, key), 'wb') as f:
+                f.write(data)
+        # Отметка пишется последней: кэш без неё считается недописанным
+        open(os.path.join(cache_dir, CHART_CACHE_COMPLETE_MARK), 'wb').close()
+    except OSError as e:
+        logging.warning(f"Не удалось сохранить графики в {CHART_CACHE_DIR}: {e}")
+
+def _render_trade_entry(trade: Dict) -> str:
+    pnl_value = trade.get('pnl_value', 0)
+    icon = "🟢" if pnl_value > 0 else "🔴" if pnl_value < 0 else "⚪️"
+    if trade.get('in_progress'): icon = "🔄"
+    direction = "▲ Long" if trade.get('type') == 'long' else "▼ Short"
+    return (f"<b>{trade['_q_ticker']}</b> ({direction}) - <code>{trade['_q_date']}</code>\n"
+            f"{icon} PnL: <code>{trade['_q_pnl']}</code> | Маржа: <code>{trade['_q_margin']}</code>\n"
+            f"ENTRY: <code>{trade['_q_entry']}</code>\n"
+            f"Фиксации: <code>{trade['_q_exits']}</code>\n--------------------\n")
+
+def _render_trade_pages(sorted_trades: List[Dict]) -> List[str]:
+    # Тело каждой страницы списка сделок собирается один раз при обновлении кэша
+    pages = ["".join(_render_trade_entry(t) for t in sorted_trades[i:i + ITEMS_PER_PAGE])
+             for i in range(0, len(sorted_trades), ITEMS_PER_PAGE)]
+    return pages or [""]
+
+async def update_stats_cache(force: bool = False):
     logging.info("Обновление кэша статистики...")
+    global parsed_stats_cache
+    if force:
+        parsed_stats_cache = None
+    stats_hash = await asyncio.to_thread(_hash_stats_file_sync)
+    if not force and stats_hash and STATS_CACHE.get("_stats_hash") == stats_hash:
+        logging.info("Файл статистики не изменился, кэш актуален.")
+        return
+
     summary, trades = await parse_stats_data()
     if not summary and not trades:
         logging.error("Не удалось загрузить данные для кэша. Проверьте stats.txt")
@@ -531,28 +831,80 @@ async def update_stats_cache():
 
     STATS_CACHE["summary"] = summary
     STATS_CACHE["trades"] = trades
+    trades_sorted_desc = sorted([t for t in trades if 'date_dt' in t], key=lambda x: x['date_dt'], reverse=True)
+    STATS_CACHE["trades_sorted_desc"] = trades_sorted_desc
+    STATS_CACHE["total_pages"] = math.ceil(len(trades_sorted_desc) / ITEMS_PER_PAGE) or 1
+    STATS_CACHE["trade_pages"] = _render_trade_pages(trades_sorted_desc)
     
     win_streak, loss_streak, be_streak = await asyncio.to_thread(_calculate_streaks_sync, trades)
     STATS_CACHE["streaks"] = {"win": win_streak, "loss": loss_streak, "be": be_streak}
-    
-    pnl_html, pnl_png = await plot_pnl_chart(trades)
-    STATS_CACHE["pnl_chart_html"], STATS_CACHE["pnl_chart_png"] = pnl_html, pnl_png
-    STATS_CACHE["summary_chart_png"] = await plot_summary_chart(summary)
 
     sim_compound_results = await calculate_simulation(trades, 'compound', 1000.0, 3.0, 35.0)
     STATS_CACHE["sim_compound_results"] = sim_compound_results
-    if sim_compound_results and sim_compound_results['history']:
-        sim_compound_html, sim_compound_png = await plot_simulation_chart(sim_compound_results['history'])
-        STATS_CACHE["sim_compound_chart_html"], STATS_CACHE["sim_compound_chart_png"] = sim_compound_html, sim_compound_png
-
     sim_simple_results = await calculate_simulation(trades, 'simple', 1000.0, 3.0, 35.0)
     STATS_CACHE["sim_simple_results"] = sim_simple_results
-    if sim_simple_results and sim_simple_results['history']:
-        sim_simple_html, sim_simple_png = await plot_simulation_chart(sim_simple_results['history'])
-        STATS_CACHE["sim_simple_chart_html"], STATS_CACHE["sim_simple_chart_png"] = sim_simple_html, sim_simple_png
+    # Текст результатов для предустановленных симуляций не зависит от пользователя - форматируем один раз
+    STATS_CACHE["sim_compound_results_text"] = format_simulation_results("Сложный процент", sim_compound_results, 1000.0, 3.0, 35.0)
+    STATS_CACHE["sim_simple_results_text"] = format_simulation_results("Простой процент", sim_simple_results, 1000.0, 3.0, 35.0)
+
+    charts = await asyncio.to_thread(_load_cached_charts_sync, stats_hash) if stats_hash and not force else None
+    if charts is not None:
+        logging.info("Графики загружены из дискового кэша.")
+    else:
+        charts = dict.fromkeys(CHART_CACHE_OPTIONAL_KEYS)
+        charts["pnl_chart_html"], charts["pnl_chart_png"] = await plot_pnl_chart(trades)
+        charts["summary_chart_png"] = await plot_summary_chart(summary)
+        if sim_compound_results and sim_compound_results['history']:
+            charts["sim_compound_chart_html"], charts["sim_compound_chart_png"] = await plot_simulation_chart(sim_compound_results['history'])
+        if sim_simple_results and sim_simple_results['history']:
+            charts["sim_simple_chart_html"], charts["sim_simple_chart_png"] = await plot_simulation_chart(sim_simple_results['history'])
+        if stats_hash:
+            await asyncio.to_thread(_save_cached_charts_sync, stats_hash, charts)
+    STATS_CACHE.update(charts)
+    STATS_CACHE["_stats_hash"] = stats_hash
 
     logging.info("Кэш статистики успешно обновлен.")
 
+# Колбэки, которые журналируются с постоянной подписью: точное совпадение или префикс до ':'
+CALLBACK_LOG_LABELS = {
+    "show_help": "Помощь",
+    "show_stats": "Общая статистика",
+    "navigate_trades": "Все сделки",
+    "simulation_prompt": "Симуляция",
+}
+
+class ActionLogMiddleware(BaseMiddleware):
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]], event: CallbackQuery, data: Dict[str, Any]) -> Any:
+        callback_data = event.data or ""
+        label = CALLBACK_LOG_LABELS.get(callback_data) or CALLBACK_LOG_LABELS.get(callback_data.split(':', 1)[0])
+        if label:
+            await log_user_action(event.from_user, label)
+        return await handler(event, data)
+
+# Колбэки, обработчики которых сами отвечают текстом или алертом (на колбэк можно ответить только один раз).
+# На путях без своего текста они вызывают answer_callback_in_background сами.
+SELF_ANSWERED_CALLBACKS = frozenset({
+    "start_restore", "custom_simulation_start", "custom_sim_run", "admin_panel", "refresh_cache",
+    "clear_log_confirm", "user_profile", "ban_user", "unban_user", "export_db", "get_stats_file",
+    "add_trade_to_stats", "check_stats", "limit_user_menu",
+})
+
+async def _answer_callback_quietly(call: CallbackQuery):
+    try:
+        await call.answer()
+    except TelegramBadRequest:
+        pass
+
+def answer_callback_in_background(call: CallbackQuery):
+    asyncio.create_task(_answer_callback_quietly(call))
+
+class AutoAnswerMiddleware(BaseMiddleware):
+    # Пустой ответ на колбэк уходит в фоне до обработчика, чтобы сразу убрать часики на кнопке
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]], event: CallbackQuery, data: Dict[str, Any]) -> Any:
+        if (event.data or "").split(':', 1)[0] not in SELF_ANSWERED_CALLBACKS:
+            answer_callback_in_background(event)
+        return await handler(event, data)
+
 class AuthMiddleware(BaseMiddleware):
     async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]], event: TelegramObject, data: Dict[str, Any]) -> Any:
         if isinstance(event, (Message, CallbackQuery)) and event.chat.type == 'channel':
@@ -560,12 +912,9 @@ class AuthMiddleware(BaseMiddleware):
 
         chat = data.get('event_chat')
         if chat and chat.type in GROUP_TYPES:
-            if 'group_chats' not in database: database['group_chats'] = set()
-            elif isinstance(database['group_chats'], list): database['group_chats'] = set(database['group_chats'])
-            
             if chat.id not in database['group_chats']:
                 database['group_chats'].add(chat.id)
-                await save_database()
+                mark_db_dirty()
 
         user: User | None = data.get('event_from_user')
         if not user: return await handler(event, data)
@@ -576,43 +925,94 @@ class AuthMiddleware(BaseMiddleware):
                 await event.answer("Это меню не для вас.", show_alert=True)
                 return
 
-        if database.get('users', {}).get(str(user.id), {}).get('is_banned'):
+        if database.get('users', {}).get(user.id, {}).get('is_banned'):
             if isinstance(event, CallbackQuery): await event.answer("Вы заблокированы.", show_alert=True)
             return
         
         now = datetime.now().timestamp()
-        if user.id not in user_timestamps: user_timestamps[user.id] = []
-        user_timestamps[user.id] = [t for t in user_timestamps[user.id] if now - t < TIME_WINDOW]
-        user_timestamps[user.id].append(now)
-        if len(user_timestamps[user.id]) > SPAM_LIMIT and not is_admin(user.id):
-            user_id_str = str(user.id)
-            if not database.get('users', {}).get(user_id_str, {}).get('is_banned'):
-                database['users'][user_id_str] = {'is_banned': True}
-                await save_database()
+        timestamps = user_timestamps.get(user.id)
+        if timestamps is None:
+            timestamps = user_timestamps[user.id] = deque(maxlen=SPAM_LIMIT + 1)
+        while timestamps and now - timestamps[0] >= TIME_WINDOW:
+            timestamps.popleft()
+        timestamps.append(now)
+        if len(timestamps) > SPAM_LIMIT and not is_admin(user.id):
+            if not database.get('users', {}).get(user.id, {}).get('is_banned'):
+                if user.id in database['users']:
+                    update_username_index(user.id, database['users'][user.id].get('username'), None)
+                user_counters['banned'] += 1
+                forget_user_activity(user.id)
+                add_user_record_counted(user.id, {'is_banned': True})
+                mark_db_dirty()
                 try:
                     sent_msg = await bot.send_message(user.id, f"Вы были автоматически заблокированы за спам.\nДля разблокировки обратитесь к @{ADMIN_TELEGRAM_USERNAME}")
-                    asyncio.create_task(delete_message_after_delay(sent_msg, sent_msg.chat.type))
+                    schedule_delete(sent_msg, sent_msg.chat.type)
                 except TelegramBadRequest: pass
-                username = f"@{user.username}" if user.username else f"id:{user_id_str}"
-                await log_system_action(f"‼️ Пользователь {html.quote(username)} (<code>{user_id_str}</code>) был автоматически забанен за спам.")
+                username = f"@{user.username}" if user.username else f"id:{user.id}"
+                await log_system_action(f"‼️ Пользователь {html.quote(username)} (<code>{user.id}</code>) был автоматически забанен за спам.")
             return
         
         await update_user_data(user)
         return await handler(event, data)
 
+@functools.lru_cache(maxsize=1024)
+def _format_user_mention(user_id: int, first_name: str) -> str:
+    return f'<a href="tg://user?id={user_id}">{html.quote(first_name)}</a>'
+
 def get_user_mention(user: User) -> str:
-    return f'<a href="tg://user?id={user.id}">{html.quote(user.first_name)}</a>'
+    # Кэш по (id, имя): при смене имени просто появится новая запись
+    return _format_user_mention(user.id, user.first_name)
 
-async def delete_message_after_delay(message: Message, chat_type: str):
-    delay = GROUP_AUTODELETE_SECONDS if chat_type in GROUP_TYPES else PRIVATE_AUTODELETE_SECONDS
+def get_autodelete_delay(chat_type: str) -> int:
+    return GROUP_AUTODELETE_SECONDS if chat_type in GROUP_TYPES else PRIVATE_AUTODELETE_SECONDS
+
+def schedule_delete(message: Message, chat_type: str):
+    delay = get_autodelete_delay(chat_type)
     if delay <= 0: return
-    
-    await asyncio.sleep(delay)
-    try:
-        await message.delete()
-        if message.message_id in message_owners:
-            del message_owners[message.message_id]
-    except TelegramBadRequest: pass
+
+    key = (message.chat.id, message.message_id)
+    due = time.monotonic() + delay
+    pending_deletes[key] = due
+    heapq.heappush(delete_heap, (due, *key))
+    delete_wakeup.set()
+
+def cancel_scheduled_delete(chat_id: int, message_id: int):
+    # Запись в куче остаётся и будет пропущена сборщиком: её срок уже не совпадает с pending_deletes
+    pending_deletes.pop((chat_id, message_id), None)
+
+async def delete_sweeper():
+    # Одна фоновая задача удаляет все просроченные сообщения вместо отдельной спящей задачи на каждое
+    while True:
+        try:
+            if not delete_heap:
+                delete_wakeup.clear()
+                await delete_wakeup.wait()
+                continue
+            timeout = delete_heap[0][0] - time.monotonic()
+            if timeout > 0:
+                delete_wakeup.clear()
+                try: await asyncio.wait_for(delete_wakeup.wait(), timeout)
+                except asyncio.TimeoutError: pass
+                continue
+
+            now = time.monotonic()
+            due_by_chat: Dict[int, List[int]] = {}
+            while delete_heap and delete_heap[0][0] <= now:
+                due, chat_id, message_id = heapq.heappop(delete_heap)
+                if pending_deletes.get((chat_id, message_id)) == due:
+                    del pending_deletes[(chat_id, message_id)]
+                    due_by_chat.setdefault(chat_id, []).append(message_id)
+            for chat_id, ids in due_by_chat.items():
+                for message_id in ids:
+                    message_owners.pop(message_id, None)
+                for i in range(0, len(ids), DELETE_MESSAGES_BATCH):
+                    # Ошибка в одном чате (сеть, флуд-лимит, бот удалён) не должна отменять удаление в остальных
+                    try: await bot.delete_messages(chat_id, ids[i:i + DELETE_MESSAGES_BATCH])
+                    except TelegramBadRequest: pass
+                    except Exception as e:
+                        logging.warning(f"Не удалось удалить сообщения в чате {chat_id}: {e}")
+        except Exception as e:
+            logging.error(f"Ошибка в сборщике удаляемых сообщений: {e}")
 
 async def unpin_message_after_delay(chat_id: int, message_id: int, delay: int):
     if delay <= 0: return
@@ -622,100 +1022,250 @@ async def unpin_message_after_delay(chat_id: int, message_id: int, delay: int):
     except TelegramBadRequest as e:
         logging.warning(f"Не удалось открепить сообщение {message_id} в чате {chat_id}: {e}")
 
-async def update_user_data(user: User):
-    user_id_str = str(user.id)
+# --- СЧЁТЧИКИ ДЛЯ СТАТИСТИКИ БОТА ---
+# Поддерживаются при изменениях, чтобы "Статистика бота" не сканировала всех пользователей.
+# Окна активности упорядочены по времени последней активности: устаревшие записи срезаются с начала.
+
+def rebuild_user_stats():
+    users = database['users']
+    user_counters['total'] = len(users)
+    user_counters['banned'] = sum(1 for u in users.values() if u.get('is_banned'))
+
+    now = datetime.now()
+    day_ago = (now - timedelta(hours=24)).strftime("%Y-%m-%d %H:%M:%S")
+    week_ago = (now - timedelta(days=7)).strftime("%Y-%m-%d %H:%M:%S")
+    active_24h_users.clear()
+    active_7d_users.clear()
+    for last_act, uid in sorted((u['last_activity'], uid) for uid, u in users.items() if (u.get('last_activity') or '') >= week_ago):
+        active_7d_users[uid] = last_act
+        if last_act >= day_ago: active_24h_users[uid] = last_act
+    recent_first_starts[:] = sorted((u['first_start'], uid) for uid, u in users.items() if (u.get('first_start') or '') >= week_ago)
+
+def note_user_activity(user_id: int, timestamp: str):
+    for window in (active_24h_users, active_7d_users):
+        window[user_id] = timestamp
+        window.move_to_end(user_id)
+
+def forget_user_activity(user_id: int):
+    active_24h_users.pop(user_id, None)
+    active_7d_users.pop(user_id, None)
+    recent_first_starts[:] = [entry for entry in recent_first_starts if entry[1] != user_id]
+
+def _prune_activity_window(window: OrderedDict, threshold: str):
+    while window:
+        uid, last_act = next(iter(window.items()))
+        if last_act >= threshold: break
+        window.popitem(last=False)
+
+def get_user_stats() -> Dict[str, int]:
+    now = datetime.now()
+    day_ago = (now - timedelta(hours=24)).strftime("%Y-%m-%d %H:%M:%S")
+    week_ago = (now - timedelta(days=7)).strftime("%Y-%m-%d %H:%M:%S")
+    _prune_activity_window(active_24h_users, day_ago)
+    _prune_activity_window(active_7d_users, week_ago)
+    del recent_first_starts[:bisect.bisect_left(recent_first_starts, (week_ago,))]
+    today_idx = bisect.bisect_left(recent_first_starts, (now.strftime("%Y-%m-%d"),))
+    return {
+        'total': user_counters['total'], 'banned': user_counters['banned'],
+        'active_24h': len(active_24h_users), 'active_7d': len(active_7d_users),
+        'new_today': len(recent_first_starts) - today_idx, 'new_week': len(recent_first_starts),
+    }
+
+def rebuild_username_index():
+    global search_corpus
+    username_index.clear()
+    display_labels.clear()
+    limit_buttons.clear()
+    for uid, u in database['users'].items():
+        if u.get('username'):
+            username_index[u['username'].lower()] = uid
+    search_corpus = None
+
+def update_username_index(user_id: int, old_username: str | None, new_username: str | None):
+    # Вызывается при любом изменении имён пользователя, поэтому заодно сбрасывает корпус для поиска
+    global search_corpus
+    if old_username and username_index.get(old_username.lower()) == user_id:
+        del username_index[old_username.lower()]
+    if new_username:
+        username_index[new_username.lower()] = user_id
+    display_labels.pop(user_id, None)
+    limit_buttons.pop(user_id, None)
+    search_corpus = None
+
+def get_search_corpus() -> List[Tuple[int, str, str]]:
+    global search_corpus
+    if search_corpus is None:
+        search_corpus = [(uid, (u.get('username') or '').lower(), (u.get('first_name') or '').lower())
+                         for uid, u in database['users'].items()]
+    return search_corpus
+
+def get_display_label(user_id: int, u_data: Dict) -> str:
+    label = display_labels.get(user_id)
+    if label is None:
+        label = display_labels[user_id] = html.quote(f"@{u_data['username']}" if u_data.get('username') else u_data.get('first_name', f"User {user_id}"))
+    return label
+
+def add_user_record(user_id: int, record: Dict):
+    # Все новые записи пользователей заводятся через эту функцию, чтобы users_order совпадал с database['users']
+    if user_id not in database['users']:
+        users_order.append(user_id)
+    database['users'][user_id] = record
+    if record.get('is_banned'): active_user_ids.discard(user_id)
+    else: active_user_ids.add(user_id)
+
+def add_user_record_counted(user_id: int, record: Dict) -> Dict:
+    # Заготовка записи без /start (бан за спам, лимиты по id) тоже учитывается в общем счётчике пользователей
+    if user_id not in database['users']:
+        user_counters['total'] += 1
+    add_user_record(user_id, record)
+    return record
+
+def rebuild_user_indexes():
+    users_order[:] = database['users'].keys()
+    active_user_ids.clear()
+    active_user_ids.update(uid for uid, u in database['users'].items() if not u.get('is_banned'))
+    rebuild_user_stats()
+    rebuild_username_index()
+
+def _update_user_data_mem(user: User) -> bool:
+    """Обновляет запись пользователя в памяти. Возвращает True, если пользователь новый или изменились его имя/юзернейм."""
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    if user_id_str not in database['users']:
-        database['users'][user_id_str] = {
+    user_db_entry = database['users'].get(user.id)
+    if user_db_entry is None:
+        add_user_record(user.id, {
             'username': user.username, 'first_name': user.first_name, 'last_name': user.last_name, 
             'first_start': now, 'last_activity': now, 'message_count': 1, 'is_banned': False, 
             'context_message_id': None, 'last_sim_time': None
-        }
+        })
+        user_counters['total'] += 1
+        recent_first_starts.append((now, user.id))
+        update_username_index(user.id, None, user.username)
+        note_user_activity(user.id, now)
+        return True
+
+    user_db_entry['last_activity'] = now
+    note_user_activity(user.id, now)
+    user_db_entry['message_count'] = user_db_entry.get('message_count', 0) + 1
+    identity = (user.username, user.first_name, user.last_name)
+    if identity == (user_db_entry.get('username'), user_db_entry.get('first_name'), user_db_entry.get('last_name')):
+        return False
+    update_username_index(user.id, user_db_entry.get('username'), user.username)
+    user_db_entry['username'], user_db_entry['first_name'], user_db_entry['last_name'] = identity
+    return True
+
+async def update_user_data(user: User):
+    # Счётчики активности сохраняются отложенно, новые пользователи и смена имени - сразу
+    if _update_user_data_mem(user):
+        await _save_database_now()
     else:
-        user_db_entry = database['users'][user_id_str]
-        user_db_entry['last_activity'] = now
-        user_db_entry['message_count'] = user_db_entry.get('message_count', 0) + 1
-        user_db_entry['username'] = user.username
-        user_db_entry['first_name'] = user.first_name
-        user_db_entry['last_name'] = user.last_name
-    await save_database()
+        mark_db_dirty()
 
 async def log_user_action(user: User, action_text: str):
     log_entry = {
         "user_id": user.id, "username": user.username or "N/A", "first_name": user.first_name, 
         "action": action_text, "timestamp": datetime.now().isoformat()
     }
-    database['action_log'].insert(0, log_entry)
-    database['action_log'] = database['action_log'][:1000]
-    await save_database()
+    # Запись в журнал идёт через очередь: фоновый писатель применяет накопившиеся записи разом
+    try:
+        action_log_queue.put_nowait(log_entry)
+    except asyncio.QueueFull:
+        database['action_log'].appendleft(log_entry)
+        mark_db_dirty()
+
+def _drain_action_log_queue():
+    # Перенесённые записи помечают БД изменённой, иначе при остановке они не попадут на диск
+    while True:
+        try:
+            database['action_log'].appendleft(action_log_queue.get_nowait())
+        except asyncio.QueueEmpty:
+            return
+        mark_db_dirty()
+
+async def action_log_writer():
+    while True:
+        database['action_log'].appendleft(await action_log_queue.get())
+        _drain_action_log_queue()
+        mark_db_dirty()
 
 def is_admin(user_id: int) -> bool:
-    return user_id in ADMIN_IDS
+    return user_id in ADMIN_IDS_SET
 
 async def log_system_action(text: str, keyboard: InlineKeyboardMarkup = None):
     log_message = f"<b>[SYSTEM]</b> {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n{text}"
-    for admin_id in ADMIN_IDS:
-        try: 
-            await bot.send_message(admin_id, log_message, reply_markup=keyboard)
-        except Exception as e: 
-            logging.warning(f"Не удалось отправить системный лог админу {admin_id}: {e}")
+    results = await _fanout([bot.send_message(admin_id, log_message, reply_markup=keyboard) for admin_id in ADMIN_IDS])
+    for admin_id, result in zip(ADMIN_IDS, results):
+        if isinstance(result, Exception):
+            logging.warning(f"Не удалось отправить системный лог админу {admin_id}: {result}")
+
+# Telegram дописывает к описанию ошибки пояснения, поэтому сравнение идёт по вхождению, а не на равенство
+_NOT_MODIFIED_ERROR = "message is not modified"
+_MESSAGE_GONE_ERRORS = ("message to delete not found", "message to edit not found")
+_IGNORED_BAD_REQUESTS = (_NOT_MODIFIED_ERROR, *_MESSAGE_GONE_ERRORS)
 
 async def safe_edit_message(call: CallbackQuery, text: str, keyboard: InlineKeyboardMarkup) -> Message | None:
     try:
         if call.message.photo:
             await call.message.delete()
             sent_msg = await call.message.answer(text, reply_markup=keyboard)
-            asyncio.create_task(delete_message_after_delay(sent_msg, call.message.chat.type))
+            schedule_delete(sent_msg, call.message.chat.type)
             return sent_msg
         else:
             return await call.message.edit_text(text, reply_markup=keyboard)
     except TelegramBadRequest as e:
-        if "message is not modified" in str(e):
-            await call.answer()
-        elif "message to delete not found" in str(e) or "message to edit not found" in str(e):
+        description = e.message
+        if _NOT_MODIFIED_ERROR in description:
+            return None
+        elif any(marker in description for marker in _MESSAGE_GONE_ERRORS):
             sent_msg = await call.message.answer(text, reply_markup=keyboard)
-            asyncio.create_task(delete_message_after_delay(sent_msg, call.message.chat.type))
+            schedule_delete(sent_msg, call.message.chat.type)
             return sent_msg
         else:
             logging.warning(f"Не удалось отредактировать сообщение: {e}. Отправляю новое.")
             try:
                 sent_msg = await call.message.answer(text, reply_markup=keyboard)
-                asyncio.create_task(delete_message_after_delay(sent_msg, call.message.chat.type))
+                schedule_delete(sent_msg, call.message.chat.type)
                 await call.message.delete()
                 return sent_msg
             except TelegramBadRequest: pass
     return None
 
+# Клавиатуры статичны, поэтому собираются один раз при импорте, а не на каждый колбэк
+_MAIN_MENU_BUTTONS = [
+    [InlineKeyboardButton(text="📊 Общая статистика", callback_data="show_stats")],
+    [InlineKeyboardButton(text="📋 Все сделки", callback_data="navigate_trades:1")],
+    [InlineKeyboardButton(text="💡 Симуляция", callback_data="simulation_prompt")],
+    [InlineKeyboardButton(text="❓ Помощь", callback_data="show_help")],
+    [InlineKeyboardButton(text="✍️ Сообщить об ошибке", url=ADMIN_CONTACT_URL)]
+]
+_MAIN_MENU = InlineKeyboardMarkup(inline_keyboard=_MAIN_MENU_BUTTONS)
+_MAIN_MENU_ADMIN = InlineKeyboardMarkup(inline_keyboard=_MAIN_MENU_BUTTONS + [
+    [InlineKeyboardButton(text="👑 Админ-панель", callback_data="admin_panel")]
+])
+_ADMIN_PANEL = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="📖 Журнал действий", callback_data="view_log:1"), InlineKeyboardButton(text="👥 Пользователи", callback_data="view_users:1")],
+    [InlineKeyboardButton(text="🚦 Лимиты", callback_data="view_limits:1"), InlineKeyboardButton(text="📈 Статистика бота", callback_data="bot_stats")],
+    [InlineKeyboardButton(text="🔄 Обновить кэш", callback_data="refresh_cache"), InlineKeyboardButton(text="📝 Обновить stats.txt", callback_data="update_stats_prompt")],
+    [InlineKeyboardButton(text="📄 Получить stats.txt", callback_data="get_stats_file"), InlineKeyboardButton(text="🧮 Рассчитать движение", callback_data="calculate_movement_start")],
+    [InlineKeyboardButton(text="🔍 Проверить статистику", callback_data="check_stats"), InlineKeyboardButton(text="📜 Логи ошибок", callback_data="view_error_log")],
+    [InlineKeyboardButton(text="📤 Экспорт БД", callback_data="export_db"), InlineKeyboardButton(text="📥 Импорт БД", callback_data="import_db_prompt")],
+    [InlineKeyboardButton(text="💬 Рассылка (ЛС)", callback_data="broadcast_prompt"), InlineKeyboardButton(text="📮 Рассылка (Группы)", callback_data="group_broadcast_prompt")],
+    [InlineKeyboardButton(text="⬅️ Назад в меню", callback_data="main_menu")]
+])
+
 def get_main_menu_keyboard(user_id: int, chat_type: str) -> InlineKeyboardMarkup:
-    buttons = [
-        [InlineKeyboardButton(text="📊 Общая статистика", callback_data="show_stats")],
-        [InlineKeyboardButton(text="📋 Все сделки", callback_data="navigate_trades:1")],
-        [InlineKeyboardButton(text="💡 Симуляция", callback_data="simulation_prompt")],
-        [InlineKeyboardButton(text="❓ Помощь", callback_data="show_help")],
-        [InlineKeyboardButton(text="✍️ Сообщить об ошибке", url=f"https://t.me/{ADMIN_TELEGRAM_USERNAME}")]
-    ]
-    is_private_chat = chat_type == "private"
-    if is_admin(user_id) and is_private_chat:
-        buttons.append([InlineKeyboardButton(text="👑 Админ-панель", callback_data="admin_panel")])
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
+    if is_admin(user_id) and chat_type == "private":
+        return _MAIN_MENU_ADMIN
+    return _MAIN_MENU
 
 def get_admin_panel_keyboard() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📖 Журнал действий", callback_data="view_log:1"), InlineKeyboardButton(text="👥 Пользователи", callback_data="view_users:1")],
-        [InlineKeyboardButton(text="🚦 Лимиты", callback_data="view_limits:1"), InlineKeyboardButton(text="📈 Статистика бота", callback_data="bot_stats")],
-        [InlineKeyboardButton(text="🔄 Обновить кэш", callback_data="refresh_cache"), InlineKeyboardButton(text="📝 Обновить stats.txt", callback_data="update_stats_prompt")],
-        [InlineKeyboardButton(text="📄 Получить stats.txt", callback_data="get_stats_file"), InlineKeyboardButton(text="🧮 Рассчитать движение", callback_data="calculate_movement_start")],
-        [InlineKeyboardButton(text="🔍 Проверить статистику", callback_data="check_stats"), InlineKeyboardButton(text="📜 Логи ошибок", callback_data="view_error_log")],
-        [InlineKeyboardButton(text="📤 Экспорт БД", callback_data="export_db"), InlineKeyboardButton(text="📥 Импорт БД", callback_data="import_db_prompt")],
-        [InlineKeyboardButton(text="💬 Рассылка (ЛС)", callback_data="broadcast_prompt"), InlineKeyboardButton(text="📮 Рассылка (Группы)", callback_data="group_broadcast_prompt")],
-        [InlineKeyboardButton(text="⬅️ Назад в меню", callback_data="main_menu")]
-    ])
+    return _ADMIN_PANEL
 
+@functools.lru_cache(maxsize=64)
 def get_back_keyboard(callback_data="main_menu") -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="⬅️ Назад", callback_data=callback_data)]])
 
 async def show_main_menu(message: Message):
-    await delete_context_message(message.from_user.id, message.chat.id)
+    await delete_messages_quietly(message.chat.id, pop_context_message_id(message.from_user.id), message.message_id)
     await log_user_action(message.from_user, f"Вызвал команду {message.text}")
     
     user_mention = get_user_mention(message.from_user)
@@ -730,11 +1280,7 @@ async def show_main_menu(message: Message):
         except TelegramBadRequest as e:
             logging.warning(f"Не удалось закрепить сообщение в чате {message.chat.id}: {e}")
 
-    asyncio.create_task(delete_message_after_delay(sent_msg, message.chat.type))
-    try:
-        await message.delete()
-    except TelegramBadRequest:
-        pass
+    schedule_delete(sent_msg, message.chat.type)
 
 @dp.message(CommandStart())
 async def command_start_handler(message: Message, state: FSMContext):
@@ -749,22 +1295,17 @@ async def command_stat_help_handler(message: Message, state: FSMContext):
     else:
         await show_main_menu(message)
 
-@dp.callback_query(F.data == "main_menu")
 async def cq_main_menu(call: CallbackQuery, state: FSMContext):
-    await delete_context_message(call.from_user.id, call.message.chat.id)
+    await delete_messages_quietly(call.message.chat.id, pop_context_message_id(call.from_user.id), call.message.message_id)
     await state.clear()
     
     user_mention = get_user_mention(call.from_user)
     text = f"👋 <b>Привет, {user_mention}!</b>\n\nЯ бот для отслеживания статистики. Используйте кнопки ниже для навигации."
     
-    try: await call.message.delete()
-    except TelegramBadRequest: pass
-    
     sent_msg = await call.message.answer(text, reply_markup=get_main_menu_keyboard(call.from_user.id, call.message.chat.type))
     message_owners[sent_msg.message_id] = call.from_user.id
-    asyncio.create_task(delete_message_after_delay(sent_msg, call.message.chat.type))
+    schedule_delete(sent_msg, call.message.chat.type)
 
-@dp.callback_query(F.data == "show_help")
 async def cq_show_help(event: CallbackQuery | Message):
     text = (
         "<b>❓ Помощь по боту</b>\n\n"
@@ -781,30 +1322,23 @@ async def cq_show_help(event: CallbackQuery | Message):
     keyboard = get_back_keyboard("main_menu")
     
     if isinstance(event, CallbackQuery):
-        await log_user_action(event.from_user, "Помощь")
         sent_msg = await safe_edit_message(event, text, keyboard)
         if sent_msg: message_owners[sent_msg.message_id] = event.from_user.id
     else:
         await log_user_action(event.from_user, "Помощь")
-        await delete_context_message(event.from_user.id, event.chat.id)
-        try: await event.delete()
-        except TelegramBadRequest: pass
+        await delete_messages_quietly(event.chat.id, pop_context_message_id(event.from_user.id), event.message_id)
         sent_msg = await event.answer(text, reply_markup=keyboard)
         message_owners[sent_msg.message_id] = event.from_user.id
-        asyncio.create_task(delete_message_after_delay(sent_msg, event.chat.type))
+        schedule_delete(sent_msg, event.chat.type)
 
 
-@dp.callback_query(F.data == "show_stats")
 async def cq_show_stats(call: CallbackQuery):
-    await call.answer()
-    await delete_context_message(call.from_user.id, call.message.chat.id)
-    await log_user_action(call.from_user, "Общая статистика")
-    
     summary = STATS_CACHE.get("summary", {})
-    png_buf = STATS_CACHE.get("summary_chart_png")
+    png_bytes = STATS_CACHE.get("summary_chart_png")
     streaks = STATS_CACHE.get("streaks", {})
     
     if not summary:
+        await delete_context_message(call.from_user.id, call.message.chat.id)
         sent_msg = await safe_edit_message(call, "❌ Ошибка: не удалось загрузить данные статистики. Проверьте формат файла `stats.txt`.", get_back_keyboard("main_menu"))
         if sent_msg: message_owners[sent_msg.message_id] = call.from_user.id
         return
@@ -823,26 +1357,20 @@ async def cq_show_stats(call: CallbackQuery):
             f"  - В минус: <code>{streaks.get('loss', 0)}</code>\n"
             f"  - В Б/У: <code>{streaks.get('be', 0)}</code>")
     
-    try: await call.message.delete()
-    except TelegramBadRequest: pass
+    await delete_messages_quietly(call.message.chat.id, pop_context_message_id(call.from_user.id), call.message.message_id)
 
-    if png_buf:
-        png_buf.seek(0)
-        photo_file = BufferedInputFile(png_buf.read(), "summary.png")
+    if png_bytes:
+        photo_file = BufferedInputFile(png_bytes, "summary.png")
         sent_msg = await call.message.answer_photo(photo=photo_file, caption=text, reply_markup=get_back_keyboard("main_menu"))
         message_owners[sent_msg.message_id] = call.from_user.id
-        asyncio.create_task(delete_message_after_delay(sent_msg, call.message.chat.type))
+        schedule_delete(sent_msg, call.message.chat.type)
     else:
         sent_msg = await call.message.answer(text + "\n\n<i>(Не удалось сгенерировать график)</i>", reply_markup=get_back_keyboard("main_menu"))
         message_owners[sent_msg.message_id] = call.from_user.id
-        asyncio.create_task(delete_message_after_delay(sent_msg, call.message.chat.type))
+        schedule_delete(sent_msg, call.message.chat.type)
 
 
-@dp.callback_query(F.data.startswith("navigate_trades:"))
 async def cq_navigate_trades(call: CallbackQuery):
-    await call.answer()
-    await log_user_action(call.from_user, "Все сделки")
-    
     page = int(call.data.split(':')[1])
     trades = STATS_CACHE.get("trades", [])
     if not trades:
@@ -850,24 +1378,13 @@ async def cq_navigate_trades(call: CallbackQuery):
         if sent_msg: message_owners[sent_msg.message_id] = call.from_user.id
         return
     
-    sorted_trades = sorted([t for t in trades if 'date_dt' in t], key=lambda x: x['date_dt'], reverse=True)
-    
-    total_pages = math.ceil(len(sorted_trades) / ITEMS_PER_PAGE) or 1
+    total_pages = STATS_CACHE.get("total_pages", 1)
     page = max(1, min(page, total_pages))
     
-    trades_on_page = sorted_trades[(page - 1) * ITEMS_PER_PAGE:page * ITEMS_PER_PAGE]
+    trade_pages = STATS_CACHE.get("trade_pages", [""])
     
     user_mention = get_user_mention(call.from_user)
-    page_text = f"{user_mention}, вот <b>список сделок (Стр. {page}/{total_pages})</b>\n\n"
-    for trade in trades_on_page:
-        pnl_value = trade.get('pnl_value', 0)
-        icon = "🟢" if pnl_value > 0 else "🔴" if pnl_value < 0 else "⚪️"
-        if trade.get('in_progress'): icon = "🔄"
-        direction = "▲ Long" if trade.get('type') == 'long' else "▼ Short"
-        page_text += (f"<b>{html.quote(trade.get('ticker', 'N/A'))}</b> ({direction}) - <code>{html.quote(trade.get('date', 'N/A'))}</code>\n"
-                      f"{icon} PnL: <code>{html.quote(trade.get('pnl', 'N/A'))}</code> | Маржа: <code>{html.quote(trade.get('margin', 'N/A'))}</code>\n"
-                      f"ENTRY: <code>{html.quote(trade.get('entry', 'N/A'))}</code>\n"
-                      f"Фиксации: <code>{html.quote(trade.get('exits', 'б/у'))}</code>\n--------------------\n")
+    page_text = f"{user_mention}, вот <b>список сделок (Стр. {page}/{total_pages})</b>\n\n" + trade_pages[page - 1]
     
     nav = []
     if page > 1: nav.append(InlineKeyboardButton(text="⬅️", callback_data=f"navigate_trades:{page-1}"))
@@ -880,39 +1397,35 @@ async def cq_navigate_trades(call: CallbackQuery):
     user_id = call.from_user.id
 
     if page == 1:
-        png_buf = STATS_CACHE.get("pnl_chart_png")
-        html_buf = STATS_CACHE.get("pnl_chart_html")
+        png_bytes = STATS_CACHE.get("pnl_chart_png")
+        html_bytes = STATS_CACHE.get("pnl_chart_html")
 
-        if not png_buf or not html_buf:
+        if not png_bytes or not html_bytes:
             logging.error("Графики PnL не найдены в кэше для страницы 1.")
             sent_msg = await safe_edit_message(call, page_text, keyboard)
             if sent_msg: message_owners[sent_msg.message_id] = user_id
             return
 
-        try: await call.message.delete()
-        except TelegramBadRequest: pass
-        await delete_context_message(user_id, chat_id)
+        await delete_messages_quietly(chat_id, pop_context_message_id(user_id), call.message.message_id)
 
-        html_buf.seek(0)
-        file_doc = BufferedInputFile(html_buf.read(), "interactive_pnl.html")
-        file_msg = await bot.send_document(chat_id, file_doc, caption="📄 Интерактивный график PnL")
-        await save_context_message(user_id, file_msg.message_id) 
-        
-        png_buf.seek(0)
-        photo_doc = BufferedInputFile(png_buf.read(), "pnl.png")
-        sent_msg = await bot.send_photo(chat_id, photo=photo_doc, caption=page_text, reply_markup=keyboard)
+        file_doc = BufferedInputFile(html_bytes, "interactive_pnl.html")
+        photo_doc = BufferedInputFile(png_bytes, "pnl.png")
+        # Документ и фото отправляются параллельно, а не друг за другом
+        file_msg, sent_msg = await asyncio.gather(
+            bot.send_document(chat_id, file_doc, caption="📄 Интерактивный график PnL"),
+            bot.send_photo(chat_id, photo=photo_doc, caption=page_text, reply_markup=keyboard),
+        )
+        await save_context_message(user_id, file_msg.message_id)
         
         message_owners[sent_msg.message_id] = user_id
-        asyncio.create_task(delete_message_after_delay(sent_msg, call.message.chat.type))
+        schedule_delete(sent_msg, call.message.chat.type)
     else:
         sent_msg = await safe_edit_message(call, page_text, keyboard)
         if sent_msg: message_owners[sent_msg.message_id] = user_id
 
-@dp.callback_query(F.data == "simulation_prompt")
 async def cq_simulation_prompt(call: CallbackQuery, state: FSMContext):
     await delete_context_message(call.from_user.id, call.message.chat.id)
     await state.clear()
-    await log_user_action(call.from_user, "Симуляция")
     
     user_mention = get_user_mention(call.from_user)
     text = f"{user_mention},\n⚙️ Выберите тип симуляции:"
@@ -942,51 +1455,45 @@ def format_simulation_results(sim_type_text, results, initial_balance, risk_perc
             f"  - Итоговый баланс: <code>${results['final_balance']:,.0f}</code></blockquote>")
 
 async def handle_simulation(call: CallbackQuery, sim_type: str, results_key: str, chart_html_key: str, chart_png_key: str, balance: float, risk: float, leverage: float):
-    await call.answer()
-    await delete_context_message(call.from_user.id, call.message.chat.id)
-    
     type_text = "Сложный процент" if sim_type == "compound" else "Простой процент"
     await log_user_action(call.from_user, f"Симуляция ({type_text})")
     
     results = STATS_CACHE.get(results_key)
-    html_buf = STATS_CACHE.get(chart_html_key)
-    png_buf = STATS_CACHE.get(chart_png_key)
+    html_bytes = STATS_CACHE.get(chart_html_key)
+    png_bytes = STATS_CACHE.get(chart_png_key)
     
-    if not all([results, html_buf, png_buf]):
+    if not all([results, html_bytes, png_bytes]):
+        await delete_context_message(call.from_user.id, call.message.chat.id)
         sent_msg = await safe_edit_message(call, "Ошибка: данные для симуляции не найдены в кэше. Попробуйте обновить кэш.", get_back_keyboard("simulation_prompt"))
         if sent_msg: message_owners[sent_msg.message_id] = call.from_user.id
         return
         
     user_mention = get_user_mention(call.from_user)
-    result_text = f"{user_mention}, вот ваши результаты:\n\n" + format_simulation_results(type_text, results, balance, risk, leverage)
+    results_text = STATS_CACHE.get(f"{results_key}_text") or format_simulation_results(type_text, results, balance, risk, leverage)
+    result_text = f"{user_mention}, вот ваши результаты:\n\n" + results_text
     
     chat_id = call.message.chat.id
     user_id = call.from_user.id
 
-    try: await call.message.delete()
-    except TelegramBadRequest: pass
+    await delete_messages_quietly(chat_id, pop_context_message_id(user_id), call.message.message_id)
 
-    html_buf.seek(0)
-    file_doc = BufferedInputFile(html_buf.read(), f"interactive_sim_{sim_type}.html")
-    file_msg = await bot.send_document(chat_id, file_doc, caption=f"📄 Интерактивный график ({type_text})")
+    file_doc = BufferedInputFile(html_bytes, f"interactive_sim_{sim_type}.html")
+    photo_doc = BufferedInputFile(png_bytes, f"sim_{sim_type}.png")
+    file_msg, sent_msg = await asyncio.gather(
+        bot.send_document(chat_id, file_doc, caption=f"📄 Интерактивный график ({type_text})"),
+        bot.send_photo(chat_id, photo_doc, caption=result_text, reply_markup=get_back_keyboard("simulation_prompt")),
+    )
     await save_context_message(user_id, file_msg.message_id)
     
-    png_buf.seek(0)
-    photo_doc = BufferedInputFile(png_buf.read(), f"sim_{sim_type}.png")
-    sent_msg = await bot.send_photo(chat_id, photo_doc, caption=result_text, reply_markup=get_back_keyboard("simulation_prompt"))
-    
     message_owners[sent_msg.message_id] = user_id
-    asyncio.create_task(delete_message_after_delay(sent_msg, call.message.chat.type))
+    schedule_delete(sent_msg, call.message.chat.type)
 
-@dp.callback_query(F.data == "run_simulation:compound")
 async def cq_run_sim_compound(call: CallbackQuery, state: FSMContext):
     await handle_simulation(call, "compound", "sim_compound_results", "sim_compound_chart_html", "sim_compound_chart_png", 1000.0, 3.0, 35.0)
 
-@dp.callback_query(F.data == "run_simulation:simple")
 async def cq_run_sim_simple(call: CallbackQuery, state: FSMContext):
     await handle_simulation(call, "simple", "sim_simple_results", "sim_simple_chart_html", "sim_simple_chart_png", 1000.0, 3.0, 35.0)
 
-@dp.callback_query(F.data == "custom_simulation_start")
 async def cq_custom_simulation_start(call: CallbackQuery, state: FSMContext):
     await delete_context_message(call.from_user.id, call.message.chat.id)
     user_id = call.from_user.id
@@ -1002,13 +1509,14 @@ async def cq_custom_simulation_start(call: CallbackQuery, state: FSMContext):
             await log_system_action(text, keyboard)
             return
         
-        user_data = database['users'].get(str(user_id), {})
+        user_data = database['users'].get(user_id, {})
         last_sim_time_str = user_data.get('last_sim_time')
         if last_sim_time_str:
             last_sim_time = datetime.fromisoformat(last_sim_time_str)
             if datetime.now() - last_sim_time < timedelta(seconds=CUSTOM_SIM_COOLDOWN_SECONDS):
                 await call.answer(f"Пожалуйста, подождите {CUSTOM_SIM_COOLDOWN_SECONDS} секунд перед следующей симуляцией.", show_alert=True)
                 return
+    answer_callback_in_background(call)
             
     user_mention = get_user_mention(call.from_user)
     text = f"{user_mention},\n<b>Шаг 1/4:</b> Введите начальный баланс (например, 1000):"
@@ -1113,8 +1621,6 @@ async def process_leverage(message: Message, state: FSMContext):
 
 @dp.callback_query(F.data.startswith("custom_sim_run:"), StateFilter(States.get_sim_type))
 async def cq_custom_sim_run(call: CallbackQuery, state: FSMContext):
-    await call.answer()
-    
     sim_type = call.data.split(':')[1]
     user_data = await state.get_data()
     balance = user_data.get('balance')
@@ -1123,10 +1629,12 @@ async def cq_custom_sim_run(call: CallbackQuery, state: FSMContext):
     await state.clear()
 
     if any(v is None for v in [balance, risk, leverage]):
+        answer_callback_in_background(call)
         await safe_edit_message(call, "❌ Произошла ошибка, данные были утеряны. Попробуйте снова.", get_back_keyboard("simulation_prompt"))
         return
     
-    await call.message.edit_text("⏳ Считаю вашу симуляцию...")
+    # Уведомление через ответ на колбэк вместо лишнего редактирования сообщения, которое сразу удаляется
+    await call.answer("⏳ Считаю вашу симуляцию...")
     
     type_text = "Сложный процент" if sim_type == "compound" else "Простой процент"
     log_text = f"Кастомная симуляция ({type_text}): Баланс ${balance}, Риск {risk}%, Плечо x{leverage}"
@@ -1134,7 +1642,7 @@ async def cq_custom_sim_run(call: CallbackQuery, state: FSMContext):
 
     trades = STATS_CACHE.get("trades", [])
     results = await calculate_simulation(trades, sim_type, balance, risk, leverage)
-    html_buf, png_buf = await plot_simulation_chart(results['history'])
+    html_bytes, png_bytes = await plot_simulation_chart(results['history'])
     
     user_mention = get_user_mention(call.from_user)
     result_text = f"{user_mention}, вот ваша кастомная симуляция:\n\n" + format_simulation_results(f"{type_text} (кастомный)", results, balance, risk, leverage)
@@ -1145,85 +1653,73 @@ async def cq_custom_sim_run(call: CallbackQuery, state: FSMContext):
     try: await call.message.delete()
     except TelegramBadRequest: pass
 
-    if html_buf and png_buf:
-        html_buf.seek(0)
-        file_doc = BufferedInputFile(html_buf.read(), "interactive_custom_sim.html")
-        file_msg = await bot.send_document(chat_id, file_doc, caption="📄 Интерактивный график кастомной симуляции")
+    if html_bytes and png_bytes:
+        file_doc = BufferedInputFile(html_bytes, "interactive_custom_sim.html")
+        photo_doc = BufferedInputFile(png_bytes, "custom_sim.png")
+        file_msg, sent_msg = await asyncio.gather(
+            bot.send_document(chat_id, file_doc, caption="📄 Интерактивный график кастомной симуляции"),
+            bot.send_photo(chat_id, photo_doc, caption=result_text, reply_markup=get_back_keyboard("simulation_prompt")),
+        )
         await save_context_message(user_id, file_msg.message_id)
         
-        png_buf.seek(0)
-        photo_doc = BufferedInputFile(png_buf.read(), "custom_sim.png")
-        sent_msg = await bot.send_photo(chat_id, photo_doc, caption=result_text, reply_markup=get_back_keyboard("simulation_prompt"))
-        
         message_owners[sent_msg.message_id] = user_id
-        asyncio.create_task(delete_message_after_delay(sent_msg, call.message.chat.type))
+        schedule_delete(sent_msg, call.message.chat.type)
     else:
         sent_msg = await call.message.answer("❌ Ошибка: не удалось сгенерировать график для кастомной симуляции.", reply_markup=get_back_keyboard("simulation_prompt"))
         message_owners[sent_msg.message_id] = user_id
-        asyncio.create_task(delete_message_after_delay(sent_msg, call.message.chat.type))
+        schedule_delete(sent_msg, call.message.chat.type)
 
     if not is_admin(call.from_user.id):
         await increment_user_sim_limit(call.from_user.id)
-        database['users'][str(user_id)]['last_sim_time'] = datetime.now().isoformat()
-        await save_database()
+        database['users'][user_id]['last_sim_time'] = datetime.now().isoformat()
+        mark_db_dirty()
 
-@dp.callback_query(F.data == "admin_panel")
 async def cq_admin_panel(call: CallbackQuery, state: FSMContext):
     if call.message.chat.type != "private":
         return await call.answer("Админ-панель доступна только в личных сообщениях.", show_alert=True)
     if not is_admin(call.from_user.id): return await call.answer("Доступ запрещен", show_alert=True)
+    answer_callback_in_background(call)
     await delete_context_message(call.from_user.id, call.message.chat.id)
     await state.clear()
     sent_msg = await safe_edit_message(call, "👑 <b>Админ-панель</b>", get_admin_panel_keyboard())
     if sent_msg: message_owners[sent_msg.message_id] = call.from_user.id
 
-@dp.callback_query(F.data == "refresh_cache")
 async def cq_refresh_cache(call: CallbackQuery):
-    if not is_admin(call.from_user.id): return
     await call.answer("🔄 Обновляю данные и графики...", show_alert=False)
-    await update_stats_cache()
+    await update_stats_cache(force=True)
     sent_msg = await call.message.answer("✅ Кэш успешно обновлен.")
-    asyncio.create_task(delete_message_after_delay(sent_msg, call.message.chat.type))
+    schedule_delete(sent_msg, call.message.chat.type)
 
-@dp.callback_query(F.data == "bot_stats")
 async def cq_bot_stats(call: CallbackQuery):
-    if not is_admin(call.from_user.id): return
     await delete_context_message(call.from_user.id, call.message.chat.id)
-    total = len(database['users'])
-    banned = sum(1 for u in database['users'].values() if u.get('is_banned'))
-    now = datetime.now()
-    active_24h, active_7d, new_today, new_week = 0, 0, 0, 0
-    for u in database['users'].values():
-        try:
-            last_act = datetime.strptime(u['last_activity'], "%Y-%m-%d %H:%M:%S")
-            if now - last_act <= timedelta(hours=24): active_24h += 1
-            if now - last_act <= timedelta(days=7): active_7d += 1
-            first_start = datetime.strptime(u['first_start'], "%Y-%m-%d %H:%M:%S")
-            if now.date() == first_start.date(): new_today += 1
-            if now - first_start <= timedelta(days=7): new_week += 1
-        except (ValueError, KeyError): continue
-    stats_text = (f"📈 <b>Статистика бота</b>\n\n" f"👥 Всего: <b>{total}</b>\n" f"🚫 Забанено: <b>{banned}</b>\n\n"
-                  f"💡 Активных за 24ч: <b>{active_24h}</b>\n" f"💡 Активных за 7д: <b>{active_7d}</b>\n\n"
-                  f"🚀 Новых за сегодня: <b>{new_today}</b>\n" f"🚀 Новых за неделю: <b>{new_week}</b>")
+    stats = get_user_stats()
+    stats_text = (f"📈 <b>Статистика бота</b>\n\n" f"👥 Всего: <b>{stats['total']}</b>\n" f"🚫 Забанено: <b>{stats['banned']}</b>\n\n"
+                  f"💡 Активных за 24ч: <b>{stats['active_24h']}</b>\n" f"💡 Активных за 7д: <b>{stats['active_7d']}</b>\n\n"
+                  f"🚀 Новых за сегодня: <b>{stats['new_today']}</b>\n" f"🚀 Новых за неделю: <b>{stats['new_week']}</b>")
     await safe_edit_message(call, stats_text, get_back_keyboard("admin_panel"))
 
-@dp.callback_query(F.data.startswith("view_log:"))
+def _format_log_timestamp(ts: str | None) -> str:
+    # Записи журнала хранят datetime.isoformat(), поэтому обычно хватает срезов строки
+    if isinstance(ts, str) and len(ts) >= 16 and ts[4] == '-' and ts[7] == '-' and ts[13] == ':':
+        return f"{ts[8:10]}.{ts[5:7]} {ts[11:16]}"
+    try: return datetime.fromisoformat(ts).strftime('%d.%m %H:%M')
+    except (TypeError, ValueError): return "N/A"
+
 async def cq_view_log(call: CallbackQuery):
-    if not is_admin(call.from_user.id): return
     await delete_context_message(call.from_user.id, call.message.chat.id)
     page = int(call.data.split(':')[1])
     logs = database.get('action_log', [])
     if not logs: return await safe_edit_message(call, "Журнал действий пуст.", get_back_keyboard("admin_panel"))
     total_pages = math.ceil(len(logs) / LOGS_PER_PAGE) or 1
     page = max(1, min(page, total_pages))
-    logs_on_page = logs[(page - 1) * LOGS_PER_PAGE : page * LOGS_PER_PAGE]
-    text = f"📖 <b>Журнал действий (Стр. {page}/{total_pages})</b>\n\n"
+    logs_on_page = islice(logs, (page - 1) * LOGS_PER_PAGE, page * LOGS_PER_PAGE)
+    parts = [f"📖 <b>Журнал действий (Стр. {page}/{total_pages})</b>\n\n"]
     for log in logs_on_page:
         user_name = html.quote(log.get('first_name') or f"ID: {log.get('user_id')}")
         action = html.quote(log.get('action'))
-        try: timestamp = datetime.fromisoformat(log.get('timestamp')).strftime('%d.%m %H:%M')
-        except (TypeError, ValueError): timestamp = "N/A"
-        text += f"<b>{user_name}</b>: <i>{action}</i>\n<pre>   {timestamp}</pre>\n\n"
+        timestamp = _format_log_timestamp(log.get('timestamp'))
+        parts.append(f"<b>{user_name}</b>: <i>{action}</i>\n<pre>   {timestamp}</pre>\n\n")
+    text = "".join(parts)
     nav = []
     if page > 1: nav.append(InlineKeyboardButton(text="⬅️", callback_data=f"view_log:{page-1}"))
     nav.append(InlineKeyboardButton(text=f"{page}/{total_pages}", callback_data="noop"))
@@ -1232,55 +1728,50 @@ async def cq_view_log(call: CallbackQuery):
     keyboard = InlineKeyboardMarkup(inline_keyboard=[nav, [InlineKeyboardButton(text="🗑️ Очистить Журнал", callback_data="clear_log_prompt")], get_back_keyboard("admin_panel").inline_keyboard[0]])
     await safe_edit_message(call, text, keyboard)
 
-@dp.callback_query(F.data == "clear_log_prompt")
 async def cq_clear_log_prompt(call: CallbackQuery):
-    if not is_admin(call.from_user.id): return
     keyboard = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="Да, очистить ✅", callback_data="clear_log_confirm")], [InlineKeyboardButton(text="Отмена ❌", callback_data="view_log:1")]])
     await safe_edit_message(call, "Вы уверены, что хотите полностью очистить журнал действий? Это действие необратимо.", keyboard)
 
-@dp.callback_query(F.data == "clear_log_confirm")
 async def cq_clear_log_confirm(call: CallbackQuery):
-    if not is_admin(call.from_user.id): return
-    database['action_log'] = []
-    await save_database()
+    database['action_log'].clear()
+    mark_db_dirty()
     await log_system_action(f"Администратор @{call.from_user.username} (<code>{call.from_user.id}</code>) очистил журнал действий.")
     await call.answer("Журнал действий успешно очищен.", show_alert=True)
     await cq_view_log(CallbackQuery(id=call.id, from_user=call.from_user, chat_instance=call.chat_instance, message=call.message, data="view_log:1"))
 
-@dp.callback_query(F.data.startswith("view_users:"))
 async def cq_view_users(call: CallbackQuery):
-    if not is_admin(call.from_user.id): return
     await delete_context_message(call.from_user.id, call.message.chat.id)
     page = int(call.data.split(':')[1])
-    all_users = list(database['users'].items())
-    total_pages = math.ceil(len(all_users) / ITEMS_PER_PAGE) or 1
+    total_users = len(users_order)
+    total_pages = math.ceil(total_users / ITEMS_PER_PAGE) or 1
     page = max(1, min(page, total_pages))
-    users_on_page = all_users[(page - 1) * ITEMS_PER_PAGE:page * ITEMS_PER_PAGE]
-    text = "👥 <b>Список пользователей</b>\n\n"
+    users_on_page = [(uid, database['users'][uid]) for uid in users_order[(page - 1) * ITEMS_PER_PAGE:page * ITEMS_PER_PAGE]]
+    parts = ["👥 <b>Список пользователей</b>\n\n"]
     keyboard_builder = []
     for uid, u_data in users_on_page:
         ban_status = "🚫" if u_data.get('is_banned') else "✅"
-        name = html.quote(f"@{u_data['username']}" if u_data.get('username') else u_data.get('first_name', f"User {uid}"))
-        text += f"{ban_status} {name} (<code>{uid}</code>)\n   <i>Старт: {u_data.get('first_start', 'N/A')}</i>\n\n"
+        name = get_display_label(uid, u_data)
+        parts.append(f"{ban_status} {name} (<code>{uid}</code>)\n   <i>Старт: {u_data.get('first_start', 'N/A')}</i>\n\n")
         keyboard_builder.append([InlineKeyboardButton(text=name, callback_data=f"user_profile:{uid}")])
+    text = "".join(parts)
     nav = []
     if page > 1: nav.append(InlineKeyboardButton(text="◀️", callback_data=f"view_users:{page-1}"))
     nav.append(InlineKeyboardButton(text=f"{page}/{total_pages}", callback_data="noop"))
     if page < total_pages: nav.append(InlineKeyboardButton(text="▶️", callback_data=f"view_users:{page+1}"))
-    if len(all_users) > ITEMS_PER_PAGE: keyboard_builder.append(nav)
+    if total_users > ITEMS_PER_PAGE: keyboard_builder.append(nav)
     keyboard_builder.append([InlineKeyboardButton(text="🔍 Поиск", callback_data="search_user_prompt")])
     keyboard_builder.append(get_back_keyboard("admin_panel").inline_keyboard[0])
     await safe_edit_message(call, text, InlineKeyboardMarkup(inline_keyboard=keyboard_builder))
 
-@dp.callback_query(F.data.startswith("user_profile:"))
 async def cq_user_profile(call: CallbackQuery):
-    if not is_admin(call.from_user.id): return
     await delete_context_message(call.from_user.id, call.message.chat.id)
-    target_id_str = call.data.split(':')[1]
-    await send_user_profile(call, target_id_str)
+    target_id = int(call.data.split(':')[1])
+    # Для несуществующего пользователя send_user_profile сам отвечает алертом
+    if target_id in database['users']: answer_callback_in_background(call)
+    await send_user_profile(call, target_id)
 
-async def send_user_profile(event: Message | CallbackQuery, target_id_str: str):
-    user_data = database['users'].get(target_id_str)
+async def send_user_profile(event: Message | CallbackQuery, target_id: int):
+    user_data = database['users'].get(target_id)
     if not user_data:
         text = "Пользователь не найден."
         if isinstance(event, CallbackQuery): 
@@ -1288,21 +1779,21 @@ async def send_user_profile(event: Message | CallbackQuery, target_id_str: str):
             await cq_view_users(CallbackQuery(id=event.id, from_user=event.from_user, chat_instance=event.chat_instance, message=event.message, data="view_users:1"))
         else: 
             sent_msg = await event.answer(text)
-            asyncio.create_task(delete_message_after_delay(sent_msg, event.chat.type))
+            schedule_delete(sent_msg, event.chat.type)
         return
 
     ban_status = "🚫 Забанен" if user_data.get('is_banned') else "✅ Активен"
     username = f"@{user_data['username']}" if user_data.get('username') else "Нет"
     profile_text = (f"👤 <b>Профиль:</b> {html.quote(user_data.get('first_name', ''))}\n\n"
-                    f"<b>ID:</b> <code>{target_id_str}</code>\n" f"<b>Юзернейм:</b> {html.quote(username)}\n"
+                    f"<b>ID:</b> <code>{target_id}</code>\n" f"<b>Юзернейм:</b> {html.quote(username)}\n"
                     f"<b>Статус:</b> {ban_status}\n\n" f"<b>Первый запуск:</b> {user_data.get('first_start', 'N/A')}\n"
                     f"<b>Активность:</b> {user_data.get('last_activity', 'N/A')}\n" f"<b>Сообщений:</b> {user_data.get('message_count', 0)}\n")
     
     ban_text = "✅ Разбанить" if user_data.get('is_banned') else "🚫 Забанить"
-    ban_cb = f"unban_user:{target_id_str}" if user_data.get('is_banned') else f"ban_user:{target_id_str}"
+    ban_cb = f"unban_user:{target_id}" if user_data.get('is_banned') else f"ban_user:{target_id}"
     
     keyboard_buttons = []
-    if int(target_id_str) != FOUNDER_ID:
+    if target_id != FOUNDER_ID:
         keyboard_buttons.append([InlineKeyboardButton(text=ban_text, callback_data=ban_cb)])
     
     keyboard_buttons.append(get_back_keyboard("view_users:1").inline_keyboard[0])
@@ -1316,29 +1807,30 @@ async def send_user_profile(event: Message | CallbackQuery, target_id_str: str):
         except TelegramBadRequest:
             logging.warning(f"Не удалось удалить сообщение {event.message_id} в send_user_profile")
         sent_msg = await event.answer(profile_text, reply_markup=keyboard)
-        asyncio.create_task(delete_message_after_delay(sent_msg, event.chat.type))
+        schedule_delete(sent_msg, event.chat.type)
 
-@dp.callback_query(F.data.startswith(("ban_user:", "unban_user:")))
 async def cq_ban_unban_user(call: CallbackQuery):
-    if not is_admin(call.from_user.id): return
     action, target_id_str = call.data.split(':')
-    if int(target_id_str) == FOUNDER_ID: return await call.answer("Нельзя изменить статус основателя.", show_alert=True)
-    user_data = database['users'].get(target_id_str)
+    target_id = int(target_id_str)
+    if target_id == FOUNDER_ID: return await call.answer("Нельзя изменить статус основателя.", show_alert=True)
+    user_data = database['users'].get(target_id)
     if not user_data: return await call.answer("Пользователь не найден.", show_alert=True)
     is_banning = action == "ban_user"
+    if bool(user_data.get('is_banned')) != is_banning:
+        user_counters['banned'] += 1 if is_banning else -1
     user_data['is_banned'] = is_banning
-    await save_database()
+    if is_banning: active_user_ids.discard(target_id)
+    else: active_user_ids.add(target_id)
+    mark_db_dirty()
     await call.answer(f"Пользователь {'забанен' if is_banning else 'разбанен'}.")
     try:
         text = f"Ваш аккаунт был заблокирован. Обратитесь: @{ADMIN_TELEGRAM_USERNAME}" if is_banning else "Ваш аккаунт был разблокирован."
-        sent_msg = await bot.send_message(target_id_str, text)
-        asyncio.create_task(delete_message_after_delay(sent_msg, "private"))
-    except Exception as e: logging.warning(f"Не удалось уведомить {target_id_str}: {e}")
-    await send_user_profile(call, target_id_str)
+        sent_msg = await bot.send_message(target_id, text)
+        schedule_delete(sent_msg, "private")
+    except Exception as e: logging.warning(f"Не удалось уведомить {target_id}: {e}")
+    await send_user_profile(call, target_id)
 
-@dp.callback_query(F.data == "search_user_prompt")
 async def cq_search_user_prompt(call: CallbackQuery, state: FSMContext):
-    if not is_admin(call.from_user.id): return
     await state.set_state(States.get_search_query)
     await safe_edit_message(call, "Введите ID, юзернейм или имя для поиска:", get_back_keyboard("view_users:1"))
 
@@ -1349,43 +1841,43 @@ async def process_user_search(message: Message, state: FSMContext):
     
     found_users = []
     if query.isdigit():
-        if query in database['users']:
-            found_users.append((query, database['users'][query]))
+        uid = int(query)
+        if uid in database['users']:
+            found_users.append((uid, database['users'][uid]))
+    else:
+        uid = username_index.get(query.lstrip('@'))
+        if uid in database['users']:
+            found_users.append((uid, database['users'][uid]))
     
     if not found_users:
-        for uid, u_data in database['users'].items():
-            username = u_data.get('username', '').lower()
-            first_name = u_data.get('first_name', '').lower()
-            
-            if query in username or query in first_name:
-                found_users.append((uid, u_data))
+        # Лишний 21-й результат нужен только чтобы понять, что показаны не все совпадения
+        matches = (uid for uid, username, first_name in get_search_corpus() if query in username or query in first_name)
+        found_users = [(uid, database['users'][uid]) for uid in islice(matches, SEARCH_RESULTS_LIMIT + 1)]
 
     try: await message.delete()
     except TelegramBadRequest: pass
 
     if not found_users:
         sent_msg = await message.answer(f"❌ Пользователь по запросу <code>{html.quote(query)}</code> не найден.", reply_markup=get_back_keyboard("view_users:1"))
-        asyncio.create_task(delete_message_after_delay(sent_msg, message.chat.type))
+        schedule_delete(sent_msg, message.chat.type)
     elif len(found_users) == 1:
         await send_user_profile(message, found_users[0][0])
     else:
         text = "Найдено несколько пользователей. Выберите нужного:"
+        if len(found_users) > SEARCH_RESULTS_LIMIT:
+            text += f"\n<i>Показаны первые {SEARCH_RESULTS_LIMIT}, уточните запрос.</i>"
         keyboard_builder = []
-        for uid, u_data in found_users[:20]:
-            name = html.quote(f"@{u_data['username']}" if u_data.get('username') else u_data.get('first_name', f"User {uid}"))
+        for uid, u_data in found_users[:SEARCH_RESULTS_LIMIT]:
+            name = get_display_label(uid, u_data)
             keyboard_builder.append([InlineKeyboardButton(text=f"{name} ({uid})", callback_data=f"user_profile:{uid}")])
         keyboard_builder.append(get_back_keyboard("view_users:1").inline_keyboard[0])
         sent_msg = await message.answer(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard_builder))
-        asyncio.create_task(delete_message_after_delay(sent_msg, message.chat.type))
+        schedule_delete(sent_msg, message.chat.type)
 
-@dp.callback_query(F.data == "view_error_log")
 async def cq_view_error_log(call: CallbackQuery):
-    if not is_admin(call.from_user.id): return
     LOG_LINES_TO_SHOW = 25
     try:
-        with open(LOG_FILE, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-        last_lines = lines[-LOG_LINES_TO_SHOW:]
+        last_lines = await asyncio.to_thread(_tail_lines_sync, LOG_FILE, LOG_LINES_TO_SHOW)
         if not last_lines:
             text = "Файл логов пуст."
         else:
@@ -1398,17 +1890,14 @@ async def cq_view_error_log(call: CallbackQuery):
     except Exception as e:
         await safe_edit_message(call, f"Ошибка чтения логов: {e}", get_back_keyboard("admin_panel"))
 
-@dp.callback_query(F.data == "export_db")
 async def cq_export_db(call: CallbackQuery):
-    if not is_admin(call.from_user.id): return
-    db_string = json.dumps(database, indent=4, ensure_ascii=False)
-    db_file = BufferedInputFile(db_string.encode('utf-8'), filename=f'db_backup_{datetime.now().strftime("%Y-%m-%d_%H-%M")}.json')
+    # orjson сразу выдаёт UTF-8 байты без промежуточной строки; сериализация идёт вне цикла событий
+    db_bytes = await asyncio.to_thread(orjson.dumps, dict(database), default=list, option=orjson.OPT_NON_STR_KEYS)
+    db_file = BufferedInputFile(db_bytes, filename=f'db_backup_{datetime.now().strftime("%Y-%m-%d_%H-%M")}.json')
     await call.message.answer_document(db_file, caption="Резервная копия базы данных.")
     await call.answer("Файл отправлен.")
 
-@dp.callback_query(F.data == "import_db_prompt")
 async def cq_import_db_prompt(call: CallbackQuery, state: FSMContext):
-    if not is_admin(call.from_user.id): return
     text = "Вы уверены, что хотите импортировать новую базу данных? <b>Текущая БД будет полностью заменена.</b> Это действие необратимо."
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="Да, я понимаю", callback_data="import_db_confirm")],
@@ -1416,9 +1905,7 @@ async def cq_import_db_prompt(call: CallbackQuery, state: FSMContext):
     ])
     await safe_edit_message(call, text, keyboard)
 
-@dp.callback_query(F.data == "import_db_confirm")
 async def cq_import_db_confirm(call: CallbackQuery, state: FSMContext):
-    if not is_admin(call.from_user.id): return
     await state.set_state(States.get_import_file)
     await safe_edit_message(call, "Пришлите файл <code>.json</code> для импорта.", get_back_keyboard("admin_panel"))
 
@@ -1429,30 +1916,42 @@ async def handle_db_import(message: Message, state: FSMContext):
         try:
             file = await bot.get_file(message.document.file_id)
             file_content = await bot.download_file(file.file_path)
-            new_db = json.loads(file_content.read())
-            if 'users' in new_db and 'admins' in new_db:
+            raw = file_content.read()
+            # Поиск подстроки по байтам намного дешевле разбора JSON, заведомо неверные файлы отсеиваются сразу
+            new_db = await asyncio.to_thread(orjson.loads, raw) if b'"users"' in raw and b'"admins"' in raw else {}
+            if isinstance(new_db, dict) and 'users' in new_db and 'admins' in new_db:
+                # Новая БД приводится к рабочему виду отдельно; живая подменяется только после успешной проверки
+                users = {int(uid): data for uid, data in new_db['users'].items()}
+                if not all(isinstance(u, dict) for u in users.values()):
+                    raise ValueError("записи пользователей должны быть объектами")
+                new_db['users'] = users
+                new_db['admins'] = frozenset(new_db['admins']) | {FOUNDER_ID}
+                new_db['group_chats'] = set(new_db.get('group_chats', []))
+                new_db['action_log'] = deque(new_db.get('action_log', []), maxlen=ACTION_LOG_LIMIT)
                 global database
-                database = new_db
-                if FOUNDER_ID not in database['admins']: database['admins'].append(FOUNDER_ID)
-                if 'action_log' not in database: database['action_log'] = []
-                await save_database()
+                old_database, database = database, new_db
+                try:
+                    rebuild_user_indexes()
+                except Exception:
+                    database = old_database
+                    rebuild_user_indexes()
+                    raise
+                mark_db_dirty()
                 sent_msg = await message.reply("✅ База данных успешно импортирована.")
-                asyncio.create_task(delete_message_after_delay(sent_msg, message.chat.type))
+                schedule_delete(sent_msg, message.chat.type)
             else: 
                 sent_msg = await message.reply("❌ Ошибка: структура файла неверна.")
-                asyncio.create_task(delete_message_after_delay(sent_msg, message.chat.type))
+                schedule_delete(sent_msg, message.chat.type)
         except Exception as e: 
             sent_msg = await message.reply(f"❌ Произошла ошибка при импорте: {e}")
-            asyncio.create_task(delete_message_after_delay(sent_msg, message.chat.type))
+            schedule_delete(sent_msg, message.chat.type)
         finally: await state.clear()
     else: 
         sent_msg = await message.reply("❌ Пришлите файл с расширением .json")
-        asyncio.create_task(delete_message_after_delay(sent_msg, message.chat.type))
-    asyncio.create_task(delete_message_after_delay(message, message.chat.type))
+        schedule_delete(sent_msg, message.chat.type)
+    schedule_delete(message, message.chat.type)
 
-@dp.callback_query(F.data == "update_stats_prompt")
 async def cq_update_stats_prompt(call: CallbackQuery, state: FSMContext):
-    if not is_admin(call.from_user.id): return
     await state.set_state(States.update_stats_file)
     await safe_edit_message(call, "Отправьте новый файл `stats.txt` для обновления.", get_back_keyboard("admin_panel"))
 
@@ -1461,8 +1960,8 @@ async def handle_stats_update(message: Message, state: FSMContext):
     if not is_admin(message.from_user.id): return
     if not message.document.file_name or not message.document.file_name.endswith('.txt'):
         sent_msg = await message.reply("❌ Ошибка: Файл не принят. Пожалуйста, отправьте файл с расширением `.txt`.", reply_markup=get_back_keyboard("admin_panel"))
-        asyncio.create_task(delete_message_after_delay(sent_msg, message.chat.type))
-        asyncio.create_task(delete_message_after_delay(message, message.chat.type))
+        schedule_delete(sent_msg, message.chat.type)
+        schedule_delete(message, message.chat.type)
         return await state.clear()
     try:
         file = await bot.get_file(message.document.file_id)
@@ -1487,25 +1986,21 @@ async def handle_stats_update(message: Message, state: FSMContext):
     except Exception as e:
         logging.error(f"Ошибка обновления stats.txt: {e}")
         sent_msg = await message.reply(f"❌ Произошла критическая ошибка при обновлении файла: {e}", reply_markup=get_back_keyboard("admin_panel"))
-        asyncio.create_task(delete_message_after_delay(sent_msg, message.chat.type))
-        asyncio.create_task(delete_message_after_delay(message, message.chat.type))
+        schedule_delete(sent_msg, message.chat.type)
+        schedule_delete(message, message.chat.type)
     finally: await state.clear()
 
-@dp.callback_query(F.data == "get_stats_file")
 async def cq_get_stats_file(call: CallbackQuery):
-    if not is_admin(call.from_user.id): return
     try:
         stats_file = BufferedInputFile.from_file(STATS_FILE, filename="stats.txt")
         sent_msg = await call.message.answer_document(stats_file, caption="Последняя версия файла `stats.txt`.")
-        await call.answer()
-        asyncio.create_task(delete_message_after_delay(sent_msg, call.message.chat.type))
+        schedule_delete(sent_msg, call.message.chat.type)
+        answer_callback_in_background(call)
     except Exception as e:
         await call.answer("❌ Не удалось отправить файл.", show_alert=True)
         logging.error(f"Ошибка отправки stats.txt: {e}")
 
-@dp.callback_query(F.data == "broadcast_prompt")
 async def cq_broadcast_prompt(call: CallbackQuery, state: FSMContext):
-    if not is_admin(call.from_user.id): return
     await state.set_state(States.get_broadcast_content)
     await safe_edit_message(call, "Отправьте сообщение (текст или фото с подписью) для рассылки пользователям в ЛС.", get_back_keyboard("admin_panel"))
 
@@ -1519,26 +2014,25 @@ async def process_broadcast_content(message: Message, state: FSMContext):
 
 @dp.callback_query(F.data.startswith("confirm_broadcast:"), StateFilter(States.confirm_broadcast))
 async def cq_confirm_broadcast(call: CallbackQuery, state: FSMContext):
+    if not is_admin(call.from_user.id): return
     await state.clear()
     admin_id = int(call.data.split(':')[1])
     content_message = broadcast_content.pop(admin_id, None)
     if not content_message: return await safe_edit_message(call, "Ошибка: сообщение для рассылки не найдено.", get_back_keyboard("admin_panel"))
     
-    active_users = [uid for uid, udata in database['users'].items() if not udata.get('is_banned')]
+    active_users = list(active_user_ids)
+    # Очередь неограниченная, put_nowait не ждёт и не переключает цикл событий на каждого получателя
     for uid in active_users:
-        await broadcast_queue.put(('copy', uid, content_message.chat.id, content_message.message_id, None))
+        broadcast_queue.put_nowait(('copy', uid, content_message.chat.id, content_message.message_id, None))
     
     await call.message.edit_text(f"✅ Рассылка в ЛС для {len(active_users)} пользователей поставлена в очередь.")
     await call.message.answer("👑 <b>Админ-панель</b>", reply_markup=get_admin_panel_keyboard())
 
-@dp.callback_query(F.data == "cancel_broadcast")
 async def cq_cancel_broadcast(call: CallbackQuery, state: FSMContext):
     await state.clear()
     await safe_edit_message(call, "Рассылка отменена.", get_back_keyboard("admin_panel"))
 
-@dp.callback_query(F.data == "group_broadcast_prompt")
 async def cq_group_broadcast_prompt(call: CallbackQuery, state: FSMContext):
-    if not is_admin(call.from_user.id): return
     await state.set_state(States.get_group_broadcast_content)
     await safe_edit_message(call, "Отправьте сообщение (текст или фото с подписью) для рассылки по группам.", get_back_keyboard("admin_panel"))
 
@@ -1577,6 +2071,7 @@ async def process_group_pin_duration(message: Message, state: FSMContext):
 
 @dp.callback_query(F.data.startswith("confirm_group_broadcast:"), StateFilter(States.confirm_group_broadcast))
 async def cq_confirm_group_broadcast(call: CallbackQuery, state: FSMContext):
+    if not is_admin(call.from_user.id): return
     data = await state.get_data()
     admin_id = int(call.data.split(':')[1])
     pin_duration = data.get('pin_duration', 0)
@@ -1591,27 +2086,29 @@ async def cq_confirm_group_broadcast(call: CallbackQuery, state: FSMContext):
         return await safe_edit_message(call, "Не найдено ни одной группы для рассылки.", get_back_keyboard("admin_panel"))
 
     for chat_id in group_chats:
-        await broadcast_queue.put(('copy_and_pin', chat_id, content_message.chat.id, content_message.message_id, pin_duration * 60))
+        broadcast_queue.put_nowait(('copy_and_pin', chat_id, content_message.chat.id, content_message.message_id, pin_duration * 60))
 
     await call.message.edit_text(f"✅ Рассылка по {len(group_chats)} группам поставлена в очередь.")
     await call.message.answer("👑 <b>Админ-панель</b>", reply_markup=get_admin_panel_keyboard())
 
-@dp.callback_query(F.data == "calculate_movement_start")
 async def cq_calculate_movement_start(call: CallbackQuery, state: FSMContext):
-    if not is_admin(call.from_user.id): return
     await state.clear() 
     await state.set_state(States.get_calc_ticker)
     await state.update_data(calc_data={})
     await safe_edit_message(call, "🧮 <b>Калькулятор движения</b>\n\n<b>Шаг 1/5:</b> Введите название монеты (тикер):", get_back_keyboard("admin_panel"))
 
+_CALC_PROMPT_FIELDS = (
+    ("ticker", "▪️ Монета: <code>{}</code>\n", html.quote),
+    ("entry", "▪️ Вход: <code>{}</code>\n", str),
+    ("margin", "▪️ Маржа: <code>x{}</code>\n", str),
+    ("direction", "▪️ Направление: <code>{}</code>\n", str.upper),
+)
+
 def _format_calc_prompt(data: dict) -> str:
-    text = "🧮 <b>Калькулятор движения</b>\n\n"
-    if "ticker" in data: text += f"▪️ Монета: <code>{html.quote(data['ticker'])}</code>\n"
-    if "entry" in data: text += f"▪️ Вход: <code>{data['entry']}</code>\n"
-    if "margin" in data: text += f"▪️ Маржа: <code>x{data['margin']}</code>\n"
-    if "direction" in data: text += f"▪️ Направление: <code>{data['direction'].upper()}</code>\n"
-    text += "\n"
-    return text
+    parts = ["🧮 <b>Калькулятор движения</b>\n\n"]
+    parts.extend(template.format(fmt(data[key])) for key, template, fmt in _CALC_PROMPT_FIELDS if key in data)
+    parts.append("\n")
+    return "".join(parts)
 
 @dp.message(StateFilter(States.get_calc_ticker))
 async def process_calc_ticker(message: Message, state: FSMContext):
@@ -1660,6 +2157,7 @@ async def process_calc_margin(message: Message, state: FSMContext):
 
 @dp.callback_query(F.data.startswith("calc_direction:"), StateFilter(States.get_calc_direction))
 async def process_calc_direction(call: CallbackQuery, state: FSMContext):
+    if not is_admin(call.from_user.id): return
     direction = call.data.split(':')[1]
     data = (await state.get_data()).get('calc_data', {})
     data['direction'] = direction
@@ -1675,7 +2173,7 @@ async def process_calc_exits(message: Message, state: FSMContext):
     direction = data['direction']
     margin = data['margin']
     exits_text = message.text
-    exits_raw = re.findall(r'([0-9.,]+)\s*\(([\d.]+)%\)', exits_text)
+    exits_raw = _EXITS_RE.findall(exits_text)
     
     await message.delete()
 
@@ -1690,7 +2188,8 @@ async def process_calc_exits(message: Message, state: FSMContext):
             return
         if total_percent < 99.9: exits.append((entry_price, 100 - total_percent))
         
-        net_movement = sum(((p - entry_price) / entry_price * 100 if direction == 'long' else (entry_price - p) / entry_price * 100) * (pct / 100) for p, pct in exits)
+        sign = 1 if direction == 'long' else -1
+        net_movement = sign / entry_price * sum((p - entry_price) * pct for p, pct in exits)
         final_pnl = net_movement * margin
 
         result_text = (f"{data['ticker']} ({direction})\n\n"
@@ -1715,12 +2214,14 @@ async def process_calc_exits(message: Message, state: FSMContext):
 
 @dp.callback_query(F.data == "add_trade_to_stats", StateFilter(States.confirm_add_trade_to_stats))
 async def cq_add_trade_to_stats(call: CallbackQuery, state: FSMContext):
+    if not is_admin(call.from_user.id): return answer_callback_in_background(call)
     data = await state.get_data()
     trade_text = data.get("final_trade_text")
     await state.clear()
 
     if not trade_text:
         return await call.answer("Ошибка: данные о сделке утеряны.", show_alert=True)
+    answer_callback_in_background(call)
     
     try:
         await call.message.edit_text("🔄 Добавляю сделку и обновляю статистику...")
@@ -1728,8 +2229,7 @@ async def cq_add_trade_to_stats(call: CallbackQuery, state: FSMContext):
         with open(STATS_FILE, 'r', encoding='utf-8') as f:
             lines = f.readlines()
         
-        separator = '--- Статистика: Илья Власов - Грабитель ММ ---'
-        sep_indices = [i for i, line in enumerate(lines) if separator in line]
+        sep_indices = _find_separators(lines)
         if len(sep_indices) < 2:
             raise ValueError("Неверная структура файла stats.txt")
         
@@ -1750,27 +2250,19 @@ async def cq_add_trade_to_stats(call: CallbackQuery, state: FSMContext):
         await call.message.edit_text(f"❌ Ошибка: {e}", reply_markup=get_back_keyboard("admin_panel"))
 
 
-@dp.callback_query(F.data == "check_stats")
 async def cq_check_stats(call: CallbackQuery):
-    if not is_admin(call.from_user.id): return
     await call.answer("🔍 Проверяю статистику...")
 
     summary_from_file, trades = await parse_stats_data()
     if not trades:
         sent_msg = await call.message.answer("❌ Не удалось найти сделки в файле `stats.txt` для проверки.", reply_markup=get_back_keyboard("admin_panel"))
-        asyncio.create_task(delete_message_after_delay(sent_msg, call.message.chat.type))
+        schedule_delete(sent_msg, call.message.chat.type)
         return
 
-    completed_trades = [t for t in trades if not t.get('in_progress')]
-    in_progress_trades_count = len(trades) - len(completed_trades)
-    
-    successful = sum(1 for t in completed_trades if t.get('pnl_value', 0) > 0)
-    losing = sum(1 for t in completed_trades if t.get('pnl_value', 0) < 0)
-    breakeven = len(completed_trades) - successful - losing
-    total_deals = len(trades)
-    winrate = (successful / (successful + losing) * 100) if (successful + losing) > 0 else 0
-    total_pnl = sum(t.get('pnl_value', 0) for t in completed_trades)
-    last_trade_date = max(t['date_dt'] for t in trades if 'date_dt' in t) if any(t.get('date_dt') for t in trades) else None
+    stats = _compute_stats_summary(trades)
+    total_pnl, winrate, total_deals = stats['total_pnl'], stats['winrate'], stats['total_deals']
+    successful, losing, breakeven = stats['successful'], stats['losing'], stats['breakeven']
+    in_progress_trades_count, last_trade_date = stats['in_progress'], stats['last_trade_date']
     
     discrepancies = []
     try:
@@ -1791,18 +2283,18 @@ async def cq_check_stats(call: CallbackQuery):
         
         file_update_date_str = summary_from_file.get('last_update')
         if file_update_date_str and last_trade_date:
-            file_update_date = datetime.strptime(file_update_date_str, "%d.%m.%y")
+            file_update_date = _parse_dotted_date(file_update_date_str)
             if file_update_date.date() != last_trade_date.date():
                  discrepancies.append(f"Дата обновления: <code>{file_update_date.strftime('%d.%m.%y')}</code> -> <code>{last_trade_date.strftime('%d.%m.%y')}</code>")
 
     except (ValueError, TypeError, KeyError) as e:
         sent_msg = await call.message.answer(f"❌ Ошибка при сравнении данных: {e}. Проверьте формат шапки в `stats.txt`.", reply_markup=get_back_keyboard("admin_panel"))
-        asyncio.create_task(delete_message_after_delay(sent_msg, call.message.chat.type))
+        schedule_delete(sent_msg, call.message.chat.type)
         return
 
     if not discrepancies:
         sent_msg = await call.message.answer("✅ Проверка завершена. Расхождений не найдено!", reply_markup=get_back_keyboard("admin_panel"))
-        asyncio.create_task(delete_message_after_delay(sent_msg, call.message.chat.type))
+        schedule_delete(sent_msg, call.message.chat.type)
     else:
         text = "⚠️ <b>Найдены расхождения в статистике!</b>\n\n" + "\n".join(discrepancies) + "\n\nХотите обновить данные в файле `stats.txt`?"
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -1810,100 +2302,84 @@ async def cq_check_stats(call: CallbackQuery):
             [InlineKeyboardButton(text="Отмена ❌", callback_data="admin_panel")]
         ])
         sent_msg = await call.message.answer(text, reply_markup=keyboard)
-        asyncio.create_task(delete_message_after_delay(sent_msg, call.message.chat.type))
+        schedule_delete(sent_msg, call.message.chat.type)
 
 async def auto_rewrite_stats_header(call: CallbackQuery):
     summary_from_file, trades = await parse_stats_data()
     if not trades:
         return await call.message.edit_text("❌ Ошибка: не удалось прочитать сделки для обновления.", reply_markup=get_back_keyboard("admin_panel"))
 
-    completed_trades = [t for t in trades if not t.get('in_progress')]
-    in_progress_trades_count = len(trades) - len(completed_trades)
-    
-    successful = sum(1 for t in completed_trades if t.get('pnl_value', 0) > 0)
-    losing = sum(1 for t in completed_trades if t.get('pnl_value', 0) < 0)
-    breakeven = len(completed_trades) - successful - losing
-    total_deals = len(trades)
-    winrate = (successful / (successful + losing) * 100) if (successful + losing) > 0 else 0
-    total_pnl = sum(t.get('pnl_value', 0) for t in completed_trades)
-    last_trade_date = max(t['date_dt'] for t in trades if 'date_dt' in t) if any(t.get('date_dt') for t in trades) else datetime.now()
+    stats = _compute_stats_summary(trades)
+    last_trade_date = stats['last_trade_date'] or datetime.now()
 
     new_header_content = (
-        f"Чистое движение: {total_pnl:.2f}%\n"
-        f"Винрейт: {winrate:.2f}%\n"
-        f"Всего сделок: {total_deals}\n"
-        f"Успешных: {successful}\n"
-        f"Убыточных: {losing}\n"
-        f"В безубыток: {breakeven}\n"
-        f"В отработке: {in_progress_trades_count}\n\n\n"
+        f"Чистое движение: {stats['total_pnl']:.2f}%\n"
+        f"Винрейт: {stats['winrate']:.2f}%\n"
+        f"Всего сделок: {stats['total_deals']}\n"
+        f"Успешных: {stats['successful']}\n"
+        f"Убыточных: {stats['losing']}\n"
+        f"В безубыток: {stats['breakeven']}\n"
+        f"В отработке: {stats['in_progress']}\n\n\n"
         f"Начало - {summary_from_file.get('start_date', 'N/A')}\n"
         f"Последнее обновление - {last_trade_date.strftime('%d.%m.%y')}\n"
         f"Если нашли ошибку/опечатку = t.me/{ADMIN_TELEGRAM_USERNAME}"
     )
     
     try:
-        with open(STATS_FILE, 'r', encoding='utf-8') as f:
-            full_content = f.read()
-        
-        separator = '--- Статистика: Илья Власов - Грабитель ММ ---'
-        new_full_content = re.sub(
-            rf"({re.escape(separator)})(.*?)({re.escape(separator)})",
-            rf"\1\n{new_header_content}\n\n\n\3",
-            full_content,
-            count=1,
-            flags=re.DOTALL
-        )
         await create_stats_backup()
-        with open(STATS_FILE, 'w', encoding='utf-8') as f:
-            f.write(new_full_content)
+        await asyncio.to_thread(_rewrite_stats_header_sync, new_header_content)
+        global parsed_stats_cache
+        parsed_stats_cache = None
         
-        await call.message.edit_text("✅ Файл `stats.txt` успешно обновлен. Обновляю кэш...")
         await update_stats_cache()
-        await call.message.edit_text("✅ Кэш обновлен!", reply_markup=get_back_keyboard("admin_panel"))
+        await call.message.edit_text("✅ Файл `stats.txt` успешно обновлен, кэш обновлен!", reply_markup=get_back_keyboard("admin_panel"))
         await log_system_action(f"Администратор @{call.from_user.username} автоматически обновил `stats.txt`.")
 
     except Exception as e:
         logging.error(f"Критическая ошибка при перезаписи stats.txt: {e}")
         await call.message.edit_text(f"❌ Ошибка при перезаписи файла: {e}", reply_markup=get_back_keyboard("admin_panel"))
 
-@dp.callback_query(F.data == "confirm_stats_rewrite")
 async def cq_confirm_stats_rewrite(call: CallbackQuery):
-    if not is_admin(call.from_user.id): return
     await call.message.edit_text("🔄 Начинаю обновление файла `stats.txt`...")
     await auto_rewrite_stats_header(call)
 
-@dp.callback_query(F.data.startswith("view_limits:"))
+def get_limit_button(user_id: int, name: str, remaining: int) -> InlineKeyboardButton:
+    # Кнопка сбрасывается при изменении лимита или имени; остаток сверяется ещё и из-за смены дня
+    cached = limit_buttons.get(user_id)
+    if cached is None or cached[0] != remaining:
+        cached = limit_buttons[user_id] = (remaining, InlineKeyboardButton(text=f"{name} ({remaining})", callback_data=f"limit_user_menu:{user_id}"))
+    return cached[1]
+
 async def cq_view_limits(call: CallbackQuery, state: FSMContext):
-    if not is_admin(call.from_user.id): return
     await state.clear()
     page = int(call.data.split(':')[1])
-    all_users = list(database['users'].items())
-    total_pages = math.ceil(len(all_users) / ITEMS_PER_PAGE) or 1
+    total_users = len(users_order)
+    total_pages = math.ceil(total_users / ITEMS_PER_PAGE) or 1
     page = max(1, min(page, total_pages))
-    users_on_page = all_users[(page - 1) * ITEMS_PER_PAGE:page * ITEMS_PER_PAGE]
+    users_on_page = [(uid, database['users'][uid]) for uid in users_order[(page - 1) * ITEMS_PER_PAGE:page * ITEMS_PER_PAGE]]
     text = f"🚦 <b>Управление лимитами (Стр. {page}/{total_pages})</b>\n\n"
     keyboard_builder = []
+    today = datetime.now().strftime("%Y-%m-%d")
     for uid, u_data in users_on_page:
-        remaining = CUSTOM_SIM_LIMIT - get_user_sim_limit(int(uid))
-        name = html.quote(f"@{u_data['username']}" if u_data.get('username') else u_data.get('first_name', f"User {uid}"))
+        remaining = CUSTOM_SIM_LIMIT - get_user_sim_limit(uid, today)
+        name = get_display_label(uid, u_data)
         text += f"👤 {name} (<code>{uid}</code>)\n   <i>Осталось попыток: <b>{remaining}</b></i>\n\n"
-        keyboard_builder.append([InlineKeyboardButton(text=f"{name} ({remaining})", callback_data=f"limit_user_menu:{uid}")])
+        keyboard_builder.append([get_limit_button(uid, name, remaining)])
     nav = []
     if page > 1: nav.append(InlineKeyboardButton(text="◀️", callback_data=f"view_limits:{page-1}"))
     nav.append(InlineKeyboardButton(text=f"{page}/{total_pages}", callback_data="noop"))
     if page < total_pages: nav.append(InlineKeyboardButton(text="▶️", callback_data=f"view_limits:{page+1}"))
-    if len(all_users) > ITEMS_PER_PAGE: keyboard_builder.append(nav)
+    if total_users > ITEMS_PER_PAGE: keyboard_builder.append(nav)
     keyboard_builder.append(get_back_keyboard("admin_panel").inline_keyboard[0])
     await safe_edit_message(call, text, InlineKeyboardMarkup(inline_keyboard=keyboard_builder))
 
-@dp.callback_query(F.data.startswith("limit_user_menu:"))
 async def cq_limit_user_menu(call: CallbackQuery, state: FSMContext):
-    if not is_admin(call.from_user.id): return
     await state.clear()
     user_id = int(call.data.split(':')[1])
-    user_data = database['users'].get(str(user_id))
+    user_data = database['users'].get(user_id)
     if not user_data: return await call.answer("Пользователь не найден", show_alert=True)
-    name = html.quote(f"@{user_data['username']}" if user_data.get('username') else user_data.get('first_name', f"User {user_id}"))
+    answer_callback_in_background(call)
+    name = get_display_label(user_id, user_data)
     remaining = CUSTOM_SIM_LIMIT - get_user_sim_limit(user_id)
     text = f"Что сделать с лимитами для {name}?\nТекущий остаток: {remaining}"
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -1912,9 +2388,7 @@ async def cq_limit_user_menu(call: CallbackQuery, state: FSMContext):
     ])
     await safe_edit_message(call, text, keyboard)
 
-@dp.callback_query(F.data.startswith("set_limit_prompt:"))
 async def cq_set_limit_prompt(call: CallbackQuery, state: FSMContext):
-    if not is_admin(call.from_user.id): return
     user_id = int(call.data.split(':')[1])
     await state.set_state(States.get_limit_set_amount)
     await state.update_data(target_user_id=user_id)
@@ -1935,64 +2409,174 @@ async def process_set_limit_amount(message: Message, state: FSMContext):
     finally:
         await message.delete()
 
+class TokenBucket:
+    """Ограничитель частоты: не больше `rate` вызовов в секунду с запасом на короткий всплеск."""
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+broadcast_bucket = TokenBucket(BROADCAST_RATE_PER_SECOND)
+
+async def _send_broadcast_task(task: Tuple):
+    action, chat_id, from_chat_id, message_id, pin_duration = task
+    await broadcast_bucket.acquire()
+    sent_message = await bot.copy_message(chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_id)
+    if action == 'copy_and_pin' and pin_duration and pin_duration > 0:
+        # Закрепление - отдельный запрос к API и расходует свой токен
+        await broadcast_bucket.acquire()
+        await bot.pin_chat_message(chat_id, sent_message.message_id, disable_notification=False)
+        asyncio.create_task(unpin_message_after_delay(chat_id, sent_message.message_id, pin_duration))
+
 async def broadcast_worker():
     while True:
         try:
             sent_total = 0
             failed_total = 0
-            failed_users = []
+            failed_users: List[int] = []
             start_time = datetime.now()
             
-            task = await broadcast_queue.get()
+            batch = [await broadcast_queue.get()]
             
+            # Очередь разбирается пачками, сообщения пачки уходят параллельно; частоту запросов ограничивает broadcast_bucket
             while True:
-                action, chat_id, from_chat_id, message_id, pin_duration = task
-                try:
-                    if action == 'copy':
-                        await bot.copy_message(chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_id)
-                    elif action == 'copy_and_pin':
-                        sent_message = await bot.copy_message(chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_id)
-                        if pin_duration and pin_duration > 0:
-                            await bot.pin_chat_message(chat_id, sent_message.message_id, disable_notification=False)
-                            asyncio.create_task(unpin_message_after_delay(chat_id, sent_message.message_id, pin_duration))
-                    
-                    sent_total += 1
-                except Exception as e:
-                    logging.error(f"Ошибка при отправке сообщения в чат {chat_id}: {e}")
-                    failed_total += 1
-                    failed_users.append(str(chat_id))
-                
-                try:
-                    task = broadcast_queue.get_nowait()
-                    broadcast_queue.task_done()
-                except asyncio.QueueEmpty:
+                while len(batch) < BROADCAST_BATCH_SIZE:
+                    try: batch.append(broadcast_queue.get_nowait())
+                    except asyncio.QueueEmpty: break
+
+                results = await _fanout([_send_broadcast_task(task) for task in batch], limit=BROADCAST_BATCH_SIZE)
+                for task, result in zip(batch, results):
                     broadcast_queue.task_done()
-                    break
+                    if isinstance(result, Exception):
+                        logging.error(f"Ошибка при отправке сообщения в чат {task[1]}: {result}")
+                        failed_total += 1
+                        failed_users.append(task[1])
+                    else:
+                        sent_total += 1
 
-                await asyncio.sleep(0.1)
+                if broadcast_queue.empty(): break
+                batch = []
 
             end_time = datetime.now()
             duration = (end_time - start_time).total_seconds()
-            report_text = (
+            report_parts = [
                 f"✅ Рассылка завершена за {duration:.2f} сек.\n\n"
                 f"Отправлено: {sent_total}\n"
                 f"Не удалось: {failed_total}"
-            )
+            ]
             if failed_users:
-                report_text += f"\n\nID с ошибкой: <code>{', '.join(failed_users)}</code>"
+                report_parts.append(f"\n\nID с ошибкой: <code>{', '.join(map(str, failed_users))}</code>")
             
-            await log_system_action(report_text)
+            await log_system_action("".join(report_parts))
 
         except Exception as e:
             logging.critical(f"Критическая ошибка в воркере рассылки: {e}")
 
+# --- МАРШРУТИЗАЦИЯ КОЛБЭКОВ ---
+# Вместо цепочки фильтров F.data на каждый колбэк - один поиск в словаре.
+# Колбэки, привязанные к состояниям FSM, зарегистрированы декораторами выше и проверяются раньше.
+CALLBACK_HANDLERS: Dict[str, Callable] = {
+    "start_restore": handle_start_restore,
+    "main_menu": cq_main_menu,
+    "show_help": cq_show_help,
+    "show_stats": cq_show_stats,
+    "simulation_prompt": cq_simulation_prompt,
+    "run_simulation:compound": cq_run_sim_compound,
+    "run_simulation:simple": cq_run_sim_simple,
+    "custom_simulation_start": cq_custom_simulation_start,
+    "admin_panel": cq_admin_panel,
+    "refresh_cache": cq_refresh_cache,
+    "bot_stats": cq_bot_stats,
+    "clear_log_prompt": cq_clear_log_prompt,
+    "clear_log_confirm": cq_clear_log_confirm,
+    "search_user_prompt": cq_search_user_prompt,
+    "view_error_log": cq_view_error_log,
+    "export_db": cq_export_db,
+    "import_db_prompt": cq_import_db_prompt,
+    "import_db_confirm": cq_import_db_confirm,
+    "update_stats_prompt": cq_update_stats_prompt,
+    "get_stats_file": cq_get_stats_file,
+    "broadcast_prompt": cq_broadcast_prompt,
+    "cancel_broadcast": cq_cancel_broadcast,
+    "group_broadcast_prompt": cq_group_broadcast_prompt,
+    "calculate_movement_start": cq_calculate_movement_start,
+    "check_stats": cq_check_stats,
+    "confirm_stats_rewrite": cq_confirm_stats_rewrite,
+}
+CALLBACK_PREFIXES: Dict[str, Callable] = {
+    "navigate_trades": cq_navigate_trades,
+    "view_log": cq_view_log,
+    "view_users": cq_view_users,
+    "user_profile": cq_user_profile,
+    "ban_user": cq_ban_unban_user,
+    "unban_user": cq_ban_unban_user,
+    "view_limits": cq_view_limits,
+    "limit_user_menu": cq_limit_user_menu,
+    "set_limit_prompt": cq_set_limit_prompt,
+}
+# Проверка прав для админских колбэков выполняется в роутере, а не в каждом обработчике
+ADMIN_CALLBACK_HANDLERS = frozenset({
+    cq_refresh_cache,
+    cq_bot_stats,
+    cq_view_log,
+    cq_clear_log_prompt,
+    cq_clear_log_confirm,
+    cq_view_users,
+    cq_user_profile,
+    cq_ban_unban_user,
+    cq_search_user_prompt,
+    cq_view_error_log,
+    cq_export_db,
+    cq_import_db_prompt,
+    cq_import_db_confirm,
+    cq_update_stats_prompt,
+    cq_get_stats_file,
+    cq_broadcast_prompt,
+    cq_group_broadcast_prompt,
+    cq_calculate_movement_start,
+    cq_check_stats,
+    cq_confirm_stats_rewrite,
+    cq_view_limits,
+    cq_limit_user_menu,
+    cq_set_limit_prompt,
+})
+_HANDLERS_WITH_STATE = frozenset(
+    handler for handler in (*CALLBACK_HANDLERS.values(), *CALLBACK_PREFIXES.values())
+    if 'state' in inspect.signature(handler).parameters
+)
+
+@dp.callback_query()
+async def route_callback(call: CallbackQuery, state: FSMContext):
+    data = call.data or ""
+    # Префиксные обработчики ждут аргумент после ':', данные без разделителя к ним не попадают
+    prefix, sep, _ = data.partition(":")
+    handler = CALLBACK_HANDLERS.get(data) or (CALLBACK_PREFIXES.get(prefix) if sep else None)
+    if handler is None or (handler in ADMIN_CALLBACK_HANDLERS and not is_admin(call.from_user.id)):
+        # AutoAnswerMiddleware пропускает колбэки с собственным ответом, поэтому без обработчика отвечаем здесь
+        if prefix in SELF_ANSWERED_CALLBACKS: answer_callback_in_background(call)
+        return
+    if handler in _HANDLERS_WITH_STATE:
+        return await handler(call, state=state)
+    return await handler(call)
+
 @dp.errors()
 async def error_handler(event: ErrorEvent):
     update = event.update
     exception = event.exception
 
-    if isinstance(exception, TelegramBadRequest) and "message to delete not found" in exception.message:
-        logging.warning(f"Обработана ошибка 'message to delete not found' для апдейта {update.update_id}.")
+    if isinstance(exception, TelegramBadRequest) and any(marker in exception.message for marker in _IGNORED_BAD_REQUESTS):
+        logging.debug(f"Пропущена безвредная ошибка '{exception.message}' для апдейта {update.update_id}.")
         return True
 
     logging.error(f"Критическая ошибка при обработке апдейта {update.update_id}: {exception}", exc_info=True)
@@ -2026,6 +2610,9 @@ async def initialize_bot_data():
     logging.info("Инициализация данных бота...")
     await initialize_stats_file()
     await load_database()
+    global db_flusher_task
+    if db_flusher_task is None or db_flusher_task.done():
+        db_flusher_task = asyncio.create_task(db_flusher())
     await update_stats_cache()
     logging.info("Данные бота успешно инициализированы.")
 
@@ -2045,24 +2632,44 @@ async def on_startup(bot: Bot):
 async def on_shutdown(bot: Bot):
     """Действия при остановке бота."""
     logging.warning("Бот останавливается...")
+    _drain_action_log_queue()
+    if db_dirty.is_set():
+        db_dirty.clear()
+        await _save_database_now()
     scheduler.shutdown()
     logging.warning("Планировщик остановлен.")
+    if chart_pool is not None:
+        chart_pool.shutdown(wait=False, cancel_futures=True)
 
 async def main():
     """Основная функция запуска."""
+    # Пул форкается до запуска любых потоков (логи, to_thread), иначе дочерний процесс может унаследовать захваченные блокировки
+    global chart_pool
+    chart_pool = ProcessPoolExecutor(max_workers=CHART_WORKERS)
+    chart_pool.submit(int).result()
     log_format = "%(asctime)s -- %(levelname)s: %(message)s"
     date_format = "%d.%m.%Y -- %H:%M:%S"
-    logging.basicConfig(level=logging.INFO, format=log_format, datefmt=date_format, handlers=[
-        logging.StreamHandler(),
-        RotatingFileHandler(LOG_FILE, maxBytes=5*1024*1024, backupCount=2, encoding='utf-8')
-    ])
+    formatter = logging.Formatter(log_format, date_format)
+    log_handlers = [logging.StreamHandler(), RotatingFileHandler(LOG_FILE, maxBytes=5*1024*1024, backupCount=2, encoding='utf-8')]
+    for handler in log_handlers:
+        handler.setFormatter(formatter)
+    # Запись логов в консоль и файл идёт в отдельном потоке, цикл событий только кладёт записи в очередь
+    global log_listener
+    log_queue = queue.SimpleQueue()
+    log_listener = QueueListener(log_queue, *log_handlers)
+    log_listener.start()
+    logging.basicConfig(level=logging.INFO, format="%(message)s", handlers=[QueueHandler(log_queue)])
     
     dp.errors.register(error_handler)
     dp.startup.register(on_startup)
     dp.shutdown.register(on_shutdown)
     dp.update.middleware(AuthMiddleware())
+    dp.callback_query.outer_middleware(ActionLogMiddleware())
+    dp.callback_query.outer_middleware(AutoAnswerMiddleware())
 
     asyncio.create_task(broadcast_worker())
+    asyncio.create_task(action_log_writer())
+    asyncio.create_task(delete_sweeper())
 
     if LAUNCH_MODE == "webhook":
         # Запуск в режиме вебхука (для Render)
@@ -2093,3 +2700,6 @@ if __name__ == "__main__":
         asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
         logging.info("Бот остановлен вручную.")
+    finally:
+        if log_listener is not None:
+            log_listener.stop()